@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Benchmark user and group synchronization against synthetic directories.
+
+For each directory size, three synchronizations are measured: the first run
+into an empty database, a re-run with no changes and a re-run after a
+fraction of the directory has churned. Wall time, throughput, query counts
+and peak memory are reported for the group and user phases of each run:
+
+    python benchmarks/run.py --users 10000 100000 1000000
+    python benchmarks/run.py --users 100000 --setting BATCH_SIZE=1000 --json results.json
+
+The database comes from DJANGO_SETTINGS_MODULE, defaulting to the test
+settings. A separate test database is created and destroyed, as with the
+test suite. LDAP searches are answered by a stand-in for a bound connection,
+so results measure the synchronization, including the paging and packing of
+search results, rather than a directory server.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ldap_sync.tests.settings')
+
+GROUP_FILTER = 'objectClass=group'
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi', 'Ivan', 'Judy', 'Mallory',
+               'Niaj', 'Olivia', 'Peggy', 'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter', 'Yolanda']
+LAST_NAMES = ['Anderson', 'Brown', 'Clark', 'Davis', 'Evans', 'Garcia', 'Harris', 'Jackson', 'Johnson', 'Lewis',
+              'Martin', 'Miller', 'Moore', 'Robinson', 'Smith', 'Taylor', 'Thomas', 'Thompson', 'White', 'Wilson']
+DEPARTMENTS = ['Engineering', 'Finance', 'Human Resources', 'Legal', 'Marketing', 'Operations', 'Sales', 'Support']
+
+
+class SyntheticDirectory(object):
+    """
+    A deterministic directory of users and groups. Entries are generated as
+    they are searched, so even very large directories are never held in
+    memory. Each user belongs to three groups, and attribute sizes are
+    modeled on typical Active Directory entries.
+    """
+    groups_per_user = 3
+
+    def __init__(self, users, groups=None, seed=0):
+        self.size = users
+        self.groups = groups or max(users // 100, 1)
+        self.random = random.Random(seed)
+        self.revisions = {}
+        self.removed = set()
+
+    def __len__(self):
+        return self.size - len(self.removed)
+
+    def churn(self, ratio):
+        """
+        Change a fraction of the users: most are modified, and the rest are
+        split evenly between added and removed users. Returns the number of
+        users changed.
+        """
+        count = max(int(len(self) * ratio), 1)
+        removed = added = count // 10
+        modified = count - added - removed
+
+        present = [i for i in self.random.sample(range(self.size), min(modified + removed, self.size))
+                   if i not in self.removed]
+        for i in present[:modified]:
+            self.revisions[i] = self.revisions.get(i, 0) + 1
+        self.removed.update(present[modified:])
+        self.size += added
+        return count
+
+    def group_dn(self, g):
+        return 'CN=Group %05d,OU=Groups,DC=example,DC=com' % g
+
+    def user_dn(self, i):
+        return 'CN=User %07d,OU=Users,DC=example,DC=com' % i
+
+    def user_groups(self, i):
+        stride = max(self.groups // self.groups_per_user, 1)
+        return sorted(set((i + k * stride) % self.groups for k in range(self.groups_per_user)))
+
+    def user(self, i):
+        username = 'user%07d' % i
+        first_name = FIRST_NAMES[i % len(FIRST_NAMES)]
+        last_name = LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        revision = self.revisions.get(i, 0)
+        if revision:
+            last_name = '%s-%d' % (last_name, revision)
+        department = DEPARTMENTS[i % len(DEPARTMENTS)]
+
+        attributes = {
+            'cn': 'User %07d' % i,
+            'mailNickname': username,
+            'sAMAccountName': username,
+            'userPrincipalName': '%s@example.com' % username,
+            'givenName': first_name,
+            'sn': last_name,
+            'displayName': '%s %s' % (first_name, last_name),
+            'mail': '%s.%s.%d@example.com' % (first_name.lower(), last_name.lower(), i),
+            'department': department,
+            'title': '%s Specialist' % department,
+            'telephoneNumber': '+1 555 %03d %04d' % (i // 10000 % 1000, i % 10000),
+            'description': 'Synthetic user %d generated for synchronization benchmarks' % i,
+            'userAccountControl': '512',
+            'uSNChanged': str(1000 + i + revision * self.size),
+        }
+        attributes = {name: [value.encode('utf-8')] for name, value in attributes.items()}
+        attributes['objectGUID'] = [i.to_bytes(16, 'little')]
+        attributes['memberOf'] = [self.group_dn(g).encode('utf-8') for g in self.user_groups(i)]
+        return self.user_dn(i), attributes
+
+    def group(self, g):
+        attributes = {
+            'cn': [('Group %05d' % g).encode('utf-8')],
+            'description': [('Synthetic group %d generated for synchronization benchmarks' % g).encode('utf-8')],
+        }
+        return self.group_dn(g), attributes
+
+    def group_members(self, g):
+        stride = max(self.groups // self.groups_per_user, 1)
+        members = set()
+        for k in range(self.groups_per_user):
+            members.update(range((g - k * stride) % self.groups, self.size, self.groups))
+        return [self.user_dn(i).encode('utf-8') for i in sorted(members) if i not in self.removed]
+
+    def entries(self, filterstr, attrlist):
+        """Yield the entries matched by a search, with only the requested attributes."""
+        if GROUP_FILTER in filterstr:
+            for g in range(self.groups):
+                cname, attributes = self.group(g)
+                if attrlist and 'member' in attrlist:
+                    attributes['member'] = self.group_members(g)
+                yield cname, self.select(attributes, attrlist)
+        else:
+            for i in range(self.size):
+                if i not in self.removed:
+                    cname, attributes = self.user(i)
+                    yield cname, self.select(attributes, attrlist)
+
+    def select(self, attributes, attrlist):
+        if not attrlist:
+            return attributes
+        return {name: attributes[name] for name in attrlist if name in attributes}
+
+
+class SyntheticConnection(object):
+    """
+    A stand-in for a bound LDAPObject answering paged searches from a
+    synthetic directory. Searches are read through the same paging, packing
+    and statistics as a directory server's results.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.searches = {}
+        self.pages = {}
+        self.msgid = 0
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        request_ctrl = [c for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType][0]
+        entries = self.searches.pop(request_ctrl.cookie, None)
+        if entries is None:
+            entries = self.directory.entries(filterstr, attrlist)
+        self.msgid += 1
+        self.pages[self.msgid] = (entries, request_ctrl.size)
+        return self.msgid
+
+    def result3(self, msgid):
+        entries, page_size = self.pages.pop(msgid)
+        page = list(itertools.islice(entries, page_size))
+        cookie = ''
+        if len(page) == page_size:
+            cookie = str(msgid)
+            self.searches[cookie] = entries
+        return ldap.RES_SEARCH_RESULT, page, msgid, [SimplePagedResultsControl(True, size=page_size, cookie=cookie)]
+
+    def unbind_s(self):
+        pass
+
+
+def measure(phase, func, entries, trace_memory):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'phase': phase,
+        'entries': entries,
+        'seconds': round(seconds, 3),
+        'entries_per_second': round(entries / seconds) if seconds else None,
+        'queries': len(queries),
+        'peak_memory_mb': round(peak / 1048576, 1) if peak is not None else None,
+    }
+
+
+def benchmark(size, churn, settings, trace_memory):
+    from django.core.management import call_command
+    from django.test import override_settings
+
+    from ldap_sync.pool import ConnectionPool
+    from ldap_sync.sync import SyncLDAP
+
+    directory = SyntheticDirectory(size)
+    results = []
+    call_command('flush', interactive=False, verbosity=0)
+
+    def bind(pool, uri):
+        return SyntheticConnection(directory)
+
+    with override_settings(**settings), mock.patch('ldap_sync.pool.ConnectionPool._bind', bind):
+        for run in ('first', 'unchanged', 'churn'):
+            changed = directory.churn(churn) if run == 'churn' else 0
+            sync_ldap = SyncLDAP()
+            for phase, func, entries in (('groups', sync_ldap.sync_groups, directory.groups),
+                                         ('users', sync_ldap.sync_users, len(directory))):
+                result = measure(phase, func, entries, trace_memory)
+                result.update({'size': size, 'run': run, 'changed': changed})
+                results.append(result)
+                report(result)
+            sync_ldap.sync_memberships()
+    # Pooled connections answer from this directory, so are not reused
+    ConnectionPool.close_all()
+
+    return results
+
+
+def report(result):
+    print('%(size)9d  %(run)-10s %(phase)-7s %(entries)9d entries  %(seconds)9.3fs  '
+          '%(entries_per_second)8s/s  %(queries)7d queries  %(peak_memory_mb)8s MB' % result)
+    sys.stdout.flush()
+
+
+def parse_setting(value):
+    name, _, value = value.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return 'LDAP_SYNC_' + name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark synchronization against synthetic directories.')
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='directory sizes to benchmark')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='fraction of users changed before the final run')
+    parser.add_argument('--setting', action='append', default=[], metavar='NAME=VALUE',
+                        help='override an LDAP_SYNC_ setting, with the value parsed as JSON if possible')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracing peak memory, which slows down the synchronization')
+    parser.add_argument('--json', help='write the results to a JSON file')
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    from django.db import connection
+
+    settings = {
+        'LDAP_SYNC_GROUP_FILTER': GROUP_FILTER,
+        'LDAP_SYNC_GROUP_ATTRIBUTES': {'cn': 'name'},
+        'LDAP_SYNC_USER_ATTRIBUTES': {
+            'mailNickname': 'username',
+            'givenName': 'first_name',
+            'sn': 'last_name',
+            'mail': 'email',
+        },
+    }
+    settings.update(parse_setting(value) for value in args.setting)
+
+    database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        results = []
+        for size in args.users:
+            results.extend(benchmark(size, args.churn, settings, not args.no_memory))
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Run synchronizations from an asyncio event loop, such as in an ASGI
+application. LDAP searches are sent and awaited on the event loop, each on
+its own pooled connection, while the database is written from Django's
+thread for synchronous code.
+"""
+import asyncio
+import logging
+import time
+from collections.abc import Mapping
+
+from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from ldap_sync.entries import EntryPacker
+from ldap_sync.search import LDAPSearch
+from ldap_sync.sync import SyncLDAP
+
+
+logger = logging.getLogger(__name__)
+
+
+class PageStream(object):
+    """
+    Pages of one or more searches, each running as a task on the event
+    loop and buffering at most ``size`` pages ahead. Pages are consumed
+    with ``async for`` on the loop, or with ``for`` from a thread running
+    under sync_to_async().
+    """
+    _done = object()
+
+    def __init__(self, searches, size):
+        self.queue = asyncio.Queue(size)
+        self.running = len(searches)
+        self.tasks = [asyncio.ensure_future(self._run(pages)) for pages in searches]
+
+    async def _run(self, pages):
+        try:
+            async for page in pages:
+                await self.queue.put((page, None))
+        except Exception as e:
+            await self.queue.put((None, e))
+        else:
+            await self.queue.put((self._done, None))
+        finally:
+            await pages.aclose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self.running:
+            page, error = await self.queue.get()
+            if error is not None:
+                raise error
+            if page is not self._done:
+                return page
+            self.running -= 1
+        raise StopAsyncIteration
+
+    def __iter__(self):
+        while True:
+            try:
+                yield async_to_sync(self.__anext__)()
+            except StopAsyncIteration:
+                return
+
+    async def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class AsyncLDAPSearch(LDAPSearch):
+    """
+    An LDAPSearch whose paged searches run on the event loop. Shards are
+    searched concurrently, at most SEARCH_THREADS at a time, each with its
+    own connection. Searches made through the synchronous interface by
+    code running under sync_to_async() are started on the event loop and
+    their pages handed back to the calling thread. Change tracking
+    searches and ranged attribute reads are not asynchronous.
+    """
+    # How long to wait for a connection to become readable before polling
+    # for results anyway, in seconds, as the client library may already
+    # have buffered them
+    poll_interval = 0.05
+
+    def __init__(self, settings, stats=None):
+        super().__init__(settings, stats=stats)
+        self.started = {}
+        self.streams = []
+
+    def _key(self, filterstr, attrlist, sharded, base, sort):
+        return filterstr, tuple(attrlist), bool(sharded) and sort is None, base, sort
+
+    def start(self, filterstr, attrlist, sharded=False, base=None, sort=None):
+        """
+        Start a search on the event loop from a thread running under
+        sync_to_async(), so it runs while the thread does other work. The
+        pages are returned by the next search_pages() call for the same
+        search.
+        """
+        key = self._key(filterstr, attrlist, sharded, base, sort)
+        self.started[key] = async_to_sync(self._start)(filterstr, attrlist, sharded, base, sort)
+
+    def search_pages(self, filterstr, attrlist, sharded=False, base=None, sort=None):
+        """
+        Search from a thread running under sync_to_async(), yielding pages
+        as the search on the event loop receives them.
+        """
+        stream = self.started.pop(self._key(filterstr, attrlist, sharded, base, sort), None)
+        if stream is None:
+            stream = async_to_sync(self._start)(filterstr, attrlist, sharded, base, sort)
+        return iter(stream)
+
+    async def _start(self, filterstr, attrlist, sharded, base, sort):
+        stream = PageStream([self.asearch_pages(filterstr, attrlist, sharded=sharded, base=base, sort=sort)],
+                            self.settings.PREFETCH_PAGES or 1)
+        self.streams.append(stream)
+        return stream
+
+    async def aclose(self):
+        """Cancel any searches that are still running."""
+        for stream in self.streams:
+            await stream.cancel()
+        self.streams = []
+        self.started = {}
+
+    async def asearch_pages(self, filterstr, attrlist, sharded=False, base=None, sort=None):
+        """The asynchronous form of search_pages()."""
+        if sort is None and sharded and (self.settings.SEARCH_SHARDS or self.settings.SHARD_ATTRIBUTE):
+            pages = self._asharded_search_pages(filterstr, attrlist)
+        else:
+            pages = self._apaged_search(base or self.settings.BASE, filterstr, attrlist, self._sort_controls(sort))
+        try:
+            async for page in pages:
+                yield page
+        finally:
+            await pages.aclose()
+
+    async def _asharded_search_pages(self, filterstr, attrlist):
+        """
+        Search every shard concurrently, yielding pages as they arrive.
+        Entries returned by more than one shard are only yielded once.
+        """
+        semaphore = asyncio.Semaphore(self.settings.SEARCH_THREADS)
+
+        async def shard_pages(base, shard_filter):
+            async with semaphore:
+                async for page in self._apaged_search(base, shard_filter, attrlist):
+                    yield page
+
+        stream = PageStream([shard_pages(base, shard_filter) for base, shard_filter in self.shards(filterstr)],
+                            self.settings.PREFETCH_PAGES or self.settings.SEARCH_THREADS)
+        seen = set()
+        try:
+            async for page in stream:
+                entries = []
+                for cname, ldap_attributes in page:
+                    if isinstance(ldap_attributes, Mapping):
+                        if cname.lower() in seen:
+                            continue
+                        seen.add(cname.lower())
+                    entries.append((cname, ldap_attributes))
+                yield entries
+        finally:
+            await stream.cancel()
+
+    async def _apaged_search(self, base, filterstr, attrlist, serverctrls=None):
+        """
+        The asynchronous form of _paged_search_ext(), waiting for each page
+        on the event loop. The search binds its own connection from the
+        pool, and is retried on another server if its server fails.
+        """
+        request_ctrl = SimplePagedResultsControl(True, size=self.settings.PAGE_SIZE, cookie='')
+        packer = EntryPacker(attrlist)
+        retries = self.settings.SEARCH_RETRIES
+        returned_dns = set() if retries else None
+        server = conn = msgid = None
+
+        try:
+            while True:
+                if conn is None:
+                    server, conn = await sync_to_async(self.pool.acquire, thread_sensitive=False)()
+                try:
+                    msgid = conn.search_ext(base, ldap.SCOPE_SUBTREE, filterstr=filterstr, attrlist=attrlist,
+                                            serverctrls=(serverctrls or []) + [request_ctrl])
+                    start = time.monotonic()
+                    result_type, result_data, result_msgid, result_ctrls = await self._result(conn, msgid)
+                    elapsed = time.monotonic() - start
+                    server.record_latency(elapsed)
+                    msgid = None
+                except self.RETRY_ERRORS as e:
+                    self.pool.release(server, conn, failed=True)
+                    failed_server, server, conn, msgid = server, None, None, None
+                    if not retries:
+                        raise
+                    retries -= 1
+                    logger.warning("Search failed on %s, retrying: %s" % (failed_server.uri, e))
+                    # Paged results cookies are only valid on the server that
+                    # issued them, so the search restarts on the next server
+                    request_ctrl.cookie = ''
+                    continue
+
+                yield self._record_page(result_data, elapsed, returned_dns, packer)
+
+                paged_ctrls = [c for c in result_ctrls if c.controlType == SimplePagedResultsControl.controlType]
+                if paged_ctrls and paged_ctrls[0].cookie:
+                    request_ctrl.cookie = paged_ctrls[0].cookie
+                else:
+                    break
+        finally:
+            if conn is not None:
+                if msgid is not None:
+                    # The search was cancelled while waiting for a page
+                    try:
+                        conn.abandon_ext(msgid)
+                    except ldap.LDAPError:
+                        pass
+                self.pool.release(server, conn)
+
+    async def _result(self, conn, msgid):
+        """Wait for every result of a message without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        fd = conn.get_option(ldap.OPT_DESC)
+        while True:
+            result = conn.result3(msgid, all=1, timeout=0)
+            if result[0] is not None:
+                return result
+
+            readable = loop.create_future()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_reader(fd)
+
+
+class AsyncSyncLDAP(SyncLDAP):
+    """
+    A SyncLDAP run from an event loop with ``await AsyncSyncLDAP().sync()``.
+    Searches run on the event loop, and the user search starts while groups
+    are being written. Database writes, callbacks and signals run in
+    Django's thread for synchronous code, so they are unchanged. Only
+    sync() runs this way; use SyncLDAP for the other methods.
+    """
+    def __init__(self):
+        super().__init__()
+
+    @property
+    def ldap(self):
+        if self._ldap is None:
+            self._ldap = AsyncLDAPSearch(self.settings, stats=self.stats)
+        return self._ldap
+
+    async def sync(self, full=False):
+        """Synchronize groups, users and group memberships, returning the SyncStats for the run."""
+        if self.settings.SOURCES:
+            raise ImproperlyConfigured("AsyncSyncLDAP does not support LDAP_SYNC_SOURCES")
+        try:
+            return await sync_to_async(super().sync, thread_sensitive=True)(full=full)
+        finally:
+            if self._ldap is not None:
+                await self._ldap.aclose()
+
+    def sync_groups(self):
+        if self.settings.GROUP_FILTER and self.settings.USER_FILTER:
+            self._start_user_search()
+        super().sync_groups()
+
+    def _start_user_search(self):
+        """Start the search a full user synchronization makes, if it is known in advance."""
+        if self.settings.DELTA_SYNC or self.settings.INCREMENTAL_ATTRIBUTE:
+            return
+        if self.settings.SERVER_SORT:
+            self.ldap.start(self.settings.USER_FILTER, self._user_attributes(), sort=self.settings.username_attribute)
+        else:
+            self.ldap.start(self.settings.USER_FILTER, self._user_attributes(), sharded=True)
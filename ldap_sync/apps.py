@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class LDAPSyncConfig(AppConfig):
+    name = 'ldap_sync'
+    verbose_name = 'LDAP sync'
+    default_auto_field = 'django.db.models.AutoField'
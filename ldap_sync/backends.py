@@ -0,0 +1,29 @@
+import logging
+
+import ldap
+
+from ldap_sync.sync import SyncLDAP
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncUserBackend(object):
+    """
+    An authentication backend that synchronizes the user being
+    authenticated from LDAP, so users created since the last
+    synchronization can log in. It never authenticates anyone itself, and
+    must be listed before the backends that do.
+    """
+    sync_class = SyncLDAP
+
+    def authenticate(self, request, username=None, **kwargs):
+        if username:
+            try:
+                self.sync_class().sync_user(username)
+            except ldap.LDAPError as e:
+                logger.error("Error synchronizing user %s: %s" % (username, e))
+        return None
+
+    def get_user(self, user_id):
+        return None
@@ -1,32 +1,52 @@
-def user_active_directory_enabled(user, attributes, created, updated):
+from ldap_sync.converters import account_enabled
+
+
+def bulk_callback(func):
+    """
+    Mark a callback as accepting a batch of users at once instead of
+    being called separately for each user.
+    """
+    func.bulk = True
+    return func
+
+
+def callback_attributes(*attributes):
+    """
+    Declare the LDAP attributes a user callback reads, so they are
+    requested by user searches and kept on each entry.
+    """
+    def decorator(func):
+        func.attributes = attributes
+        return func
+    return decorator
+
+
+@bulk_callback
+@callback_attributes('userAccountControl')
+def user_active_directory_enabled(users):
     """
     Activate/deactivate user accounts based on Active Directory's
-    userAccountControl flags. Requires 'userAccountControl'
-    to be included in LDAP_SYNC_USER_EXTRA_ATTRIBUTES.
+    userAccountControl flags.
     """
-    try:
-        user_account_control = int(attributes['userAccountControl'][0])
-        if user_account_control & 2:
-            user.is_active = False
-        else:
-            user.is_active = True
-    except KeyError:
-        pass
+    for user, attributes, created, updated in users:
+        enabled = account_enabled(attributes.get('userAccountControl', ()))
+        if enabled is not None:
+            user.is_active = enabled
 
 
-def removed_user_deactivate(user):
+@bulk_callback
+def removed_user_deactivate(users):
     """
     Deactivate user accounts that no longer appear in the
     source LDAP server.
     """
-    if user.is_active:
-        user.is_active = False
-        user.save()
+    users.filter(is_active=True).update(is_active=False)
 
 
-def removed_user_delete(user):
+@bulk_callback
+def removed_user_delete(users):
     """
     Delete user accounts that no longer appear in the
     source LDAP server.
     """
-    user.delete()
+    users.delete()
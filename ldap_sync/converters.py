@@ -0,0 +1,165 @@
+"""
+Converters turning the list of raw values LDAP returns for an attribute into
+a model field value. Each converter receives the attribute's values, which is
+an empty list if the attribute is missing from an entry.
+"""
+import re
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from django.utils.module_loading import import_string
+
+
+FILETIME_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+FILETIME_NEVER = 0x7FFFFFFFFFFFFFFF
+# YYYYMMDDHH[MM[SS]][(.|,)fraction][Z|(+|-)HH[MM]]
+GENERALIZED_TIME = re.compile(r'(\d{10}(?:\d{2}){0,2})(?:[.,](\d+))?(Z|[+-]\d{2}(?:\d{2})?)?$')
+
+
+def text(values):
+    """The first value as a string. This is the default converter."""
+    return values[0].decode('utf-8') if values else ''
+
+
+def text_list(values):
+    """Every value as a list of strings."""
+    return [value.decode('utf-8') for value in values]
+
+
+def integer(values):
+    return int(values[0]) if values else None
+
+
+def boolean(values):
+    """An LDAP Boolean, which is either TRUE or FALSE."""
+    return values[0].upper() == b'TRUE' if values else None
+
+
+def flag(mask, inverse=False):
+    """
+    Return a converter testing bits of an integer flags attribute, such as
+    Active Directory's userAccountControl. With ``inverse``, the converter
+    is true when none of the bits are set.
+    """
+    def convert(values):
+        if not values:
+            return None
+        return bool(int(values[0]) & mask) != inverse
+    convert.signature = 'flag(%d, %r)' % (mask, inverse)
+    return convert
+
+
+# userAccountControl does not have ACCOUNTDISABLE (0x2) set
+account_enabled = flag(0x2, inverse=True)
+
+
+def generalized_time(values):
+    """
+    An LDAP GeneralizedTime such as 20230401123000.0Z or
+    20230401123000+0200, as an aware datetime in UTC. A value without a
+    time zone is taken to be UTC.
+    """
+    if not values:
+        return None
+    match = GENERALIZED_TIME.match(values[0].decode('ascii').upper())
+    if match is None:
+        raise ValueError("Invalid generalized time %r" % values[0])
+    moment, fraction, offset = match.groups()
+    result = datetime.strptime(moment.ljust(14, '0'), '%Y%m%d%H%M%S')
+    if fraction:
+        result = result.replace(microsecond=int(fraction.ljust(6, '0')[:6]))
+    zone = timezone.utc
+    if offset and offset != 'Z':
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5] or 0)
+        zone = timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+    return result.replace(tzinfo=zone).astimezone(timezone.utc)
+
+
+def filetime(values):
+    """
+    An Active Directory FILETIME such as lastLogonTimestamp or
+    accountExpires, as an aware datetime. Zero and the maximum value both
+    mean never and convert to None.
+    """
+    if not values:
+        return None
+    value = int(values[0])
+    if value <= 0 or value >= FILETIME_NEVER:
+        return None
+    return FILETIME_EPOCH + timedelta(microseconds=value // 10)
+
+
+def guid(values):
+    """A binary Active Directory objectGUID as its string form."""
+    return str(uuid.UUID(bytes_le=values[0])) if values else None
+
+
+def sid(values):
+    """A binary security identifier such as objectSid as its S-1-... string form."""
+    if not values:
+        return None
+    value = values[0]
+    authority = int.from_bytes(value[2:8], 'big')
+    count = value[1]
+    subauthorities = [int.from_bytes(value[8 + i * 4:12 + i * 4], 'little') for i in range(count)]
+    return 'S-%d-%d' % (value[0], authority) + ''.join('-%d' % s for s in subauthorities)
+
+
+class AttributeMap(object):
+    """
+    An attribute mapping compiled once when settings are loaded. Each
+    mapped value is either a field name, converted with text(), or a
+    (field, converter) tuple where the converter is a callable or the
+    dotted path to one.
+    """
+    def __init__(self, mapping):
+        self.attributes = []
+        signature = []
+        for ldap_name, target in sorted(mapping.items()):
+            if isinstance(target, (list, tuple)):
+                field, converter = target
+            else:
+                field, converter = target, text
+            if isinstance(converter, str):
+                converter = import_string(converter)
+            self.attributes.append((ldap_name, field, converter))
+            signature.append((ldap_name, field, getattr(converter, 'signature', None) or
+                              '%s.%s' % (converter.__module__, converter.__qualname__)))
+        self.fields = [field for ldap_name, field, converter in self.attributes]
+        self.ldap_names = [ldap_name for ldap_name, field, converter in self.attributes]
+        # A stable description of the mapping, which unlike the repr of the
+        # converters does not vary between processes
+        self.signature = repr(signature)
+
+    def __call__(self, ldap_attributes):
+        """Return the field values for one entry."""
+        get = ldap_attributes.get
+        return {field: convert(get(ldap_name, ())) for ldap_name, field, convert in self.attributes}
+
+    def map_many(self, entries, errors=None):
+        """
+        Return the field values for each of a page of entry attributes. If
+        ``errors`` is a dictionary, an entry a converter raises ValueError or
+        TypeError for maps to None and the error is stored under the entry's
+        position instead of being raised.
+        """
+        if errors is None:
+            return [self(ldap_attributes) for ldap_attributes in entries]
+
+        field_values = []
+        for position, ldap_attributes in enumerate(entries):
+            try:
+                field_values.append(self(ldap_attributes))
+            except (ValueError, TypeError) as e:
+                errors[position] = e
+                field_values.append(None)
+        return field_values
+
+    def ldap_name(self, field):
+        """Return the LDAP attribute mapped to a field, or None."""
+        for ldap_name, mapped_field, converter in self.attributes:
+            if mapped_field == field:
+                return ldap_name
+        return None
@@ -0,0 +1,245 @@
+import base64
+import logging
+import uuid
+from collections.abc import Mapping
+
+import ldap
+from ldap.controls import KNOWN_RESPONSE_CONTROLS
+from ldap.controls import RequestControl
+from ldap.controls import ResponseControl
+from ldap.filter import escape_filter_chars
+from ldap.syncrepl import SyncDoneControl
+from ldap.syncrepl import SyncInfoMessage
+from ldap.syncrepl import SyncRequestControl
+from ldap.syncrepl import SyncStateControl
+from pyasn1.codec.ber import decoder
+from pyasn1.codec.ber import encoder
+from pyasn1.type import namedtype
+from pyasn1.type import univ
+
+from ldap_sync.entries import EntryPacker
+from ldap_sync.utils import chunked
+
+
+logger = logging.getLogger(__name__)
+
+
+class DirSyncRequestValue(univ.Sequence):
+    """
+    realReplControlValue ::= SEQUENCE {
+        parentsFirst          INTEGER,
+        maxReturnLength       INTEGER,
+        cookie                OCTET STRING
+    }
+    """
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('flags', univ.Integer()),
+        namedtype.NamedType('maxBytes', univ.Integer()),
+        namedtype.NamedType('cookie', univ.OctetString()),
+    )
+
+
+class DirSyncResponseValue(univ.Sequence):
+    """
+    realReplControlValue ::= SEQUENCE {
+        moreResults           INTEGER,
+        unused                INTEGER,
+        cookie                OCTET STRING
+    }
+    """
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('moreResults', univ.Integer()),
+        namedtype.NamedType('unused', univ.Integer()),
+        namedtype.NamedType('cookie', univ.OctetString()),
+    )
+
+
+class DirSyncControl(RequestControl, ResponseControl):
+    """
+    The Active Directory DirSync control, returning entries changed since
+    the state recorded in the cookie.
+    """
+    controlType = '1.2.840.113556.1.4.841'
+
+    # Only return objects and attributes the bound user can read, which
+    # avoids requiring the "Replicating Directory Changes" permission
+    OBJECT_SECURITY = 0x1
+
+    def __init__(self, criticality=True, flags=OBJECT_SECURITY, max_bytes=1048576, cookie=b''):
+        self.criticality = criticality
+        self.flags = flags
+        self.max_bytes = max_bytes
+        self.cookie = cookie
+        self.more_results = False
+
+    def encodeControlValue(self):
+        value = DirSyncRequestValue()
+        value.setComponentByName('flags', self.flags)
+        value.setComponentByName('maxBytes', self.max_bytes)
+        value.setComponentByName('cookie', self.cookie or b'')
+        return encoder.encode(value)
+
+    def decodeControlValue(self, encodedControlValue):
+        value, _ = decoder.decode(encodedControlValue, asn1Spec=DirSyncResponseValue())
+        self.more_results = bool(int(value.getComponentByName('moreResults')))
+        self.cookie = bytes(value.getComponentByName('cookie'))
+
+
+KNOWN_RESPONSE_CONTROLS[DirSyncControl.controlType] = DirSyncControl
+
+
+class DirSyncSearch(object):
+    """
+    Retrieve entries changed since the previous run with the Active Directory
+    DirSync control. DirSync only returns the attributes that changed, so
+    modified entries are read again in full before being synchronized.
+    """
+    identifier_attribute = 'objectGUID'
+
+    def __init__(self, ldap_search, cookie=None):
+        self.ldap = ldap_search
+        self._cookie = base64.b64decode(cookie) if cookie else b''
+        self.present = None
+
+    @property
+    def cookie(self):
+        """The cookie to store for the next run, as a string."""
+        return base64.b64encode(self._cookie).decode('ascii')
+
+    def identifier(self, ldap_attributes):
+        return str(uuid.UUID(bytes_le=ldap_attributes[self.identifier_attribute][0]))
+
+    def changes(self, filterstr, attrlist):
+        """
+        Yield (identifier, entry) tuples for each changed entry. Deleted
+        entries are yielded with an entry of None.
+        """
+        request_ctrl = DirSyncControl(cookie=self._cookie)
+        search_attrlist = list(attrlist) + [self.identifier_attribute, 'isDeleted']
+        packer = EntryPacker(search_attrlist)
+
+        while True:
+            msgid = self.ldap.conn.search_ext(self.ldap.settings.BASE, ldap.SCOPE_SUBTREE, filterstr=filterstr,
+                                              attrlist=search_attrlist, serverctrls=[request_ctrl])
+            result_type, result_data, result_msgid, result_ctrls = self.ldap.conn.result3(msgid)
+
+            incomplete = []
+            for cname, ldap_attributes in result_data:
+                if not isinstance(ldap_attributes, Mapping) or self.identifier_attribute not in ldap_attributes:
+                    continue
+
+                if ldap_attributes.get('isDeleted', [b'FALSE'])[0].upper() == b'TRUE':
+                    yield self.identifier(ldap_attributes), None
+                elif all(name in ldap_attributes for name in attrlist):
+                    yield self.identifier(ldap_attributes), (cname, packer.pack(ldap_attributes))
+                else:
+                    incomplete.append(cname)
+
+            for entry in self._read_entries(filterstr, attrlist, incomplete):
+                yield self.identifier(entry[1]), entry
+
+            dirsync_ctrls = [c for c in result_ctrls if c.controlType == DirSyncControl.controlType]
+            if not dirsync_ctrls:
+                raise ldap.UNAVAILABLE_CRITICAL_EXTENSION({'desc': 'DirSync response control not returned'})
+
+            self._cookie = request_ctrl.cookie = dirsync_ctrls[0].cookie
+            if not dirsync_ctrls[0].more_results:
+                break
+
+    def _read_entries(self, filterstr, attrlist, dns):
+        """Read the complete attributes for a list of changed entries."""
+        if not filterstr.startswith('('):
+            filterstr = '(%s)' % filterstr
+        attrlist = list(attrlist) + [self.identifier_attribute]
+
+        for chunk in chunked(dns, 100):
+            dn_filter = ''.join('(distinguishedName=%s)' % escape_filter_chars(dn) for dn in chunk)
+            for cname, ldap_attributes in self.ldap.iter_search('(&%s(|%s))' % (filterstr, dn_filter), attrlist):
+                if isinstance(ldap_attributes, Mapping) and self.identifier_attribute in ldap_attributes:
+                    yield cname, ldap_attributes
+
+
+class SyncReplSearch(object):
+    """
+    Retrieve entries changed since the previous run with the RFC 4533
+    Content Synchronization control in refreshOnly mode.
+    """
+    identifier_attribute = 'entryUUID'
+
+    def __init__(self, ldap_search, cookie=None):
+        self.ldap = ldap_search
+        self.cookie = cookie
+        self.present = None
+
+    def identifier(self, ldap_attributes):
+        return ldap_attributes[self.identifier_attribute][0].decode('utf-8').lower()
+
+    def changes(self, filterstr, attrlist):
+        """
+        Yield (identifier, entry) tuples for each changed entry. Deleted
+        entries are yielded with an entry of None. If the server uses a
+        present phase instead of sending deletes, the identifiers of all
+        unchanged entries are collected in ``present`` so deletions can be
+        inferred once iteration completes.
+        """
+        request_ctrl = SyncRequestControl(cookie=self.cookie, mode='refreshOnly')
+        search_attrlist = list(attrlist) + [self.identifier_attribute]
+        packer = EntryPacker(search_attrlist)
+        msgid = self.ldap.conn.search_ext(self.ldap.settings.BASE, ldap.SCOPE_SUBTREE, filterstr=filterstr,
+                                          attrlist=search_attrlist, serverctrls=[request_ctrl])
+        present = set()
+        present_phase = False
+
+        while True:
+            result_type, result_data, result_msgid, result_ctrls, result_name, result_value = self.ldap.conn.result4(
+                msgid, all=0, add_ctrls=1, add_intermediates=1)
+
+            if result_type == ldap.RES_SEARCH_RESULT:
+                for ctrl in result_ctrls:
+                    if ctrl.controlType == SyncDoneControl.controlType:
+                        if ctrl.cookie is not None:
+                            self.cookie = ctrl.cookie
+                        if not ctrl.refreshDeletes:
+                            present_phase = True
+                break
+
+            elif result_type == ldap.RES_SEARCH_ENTRY:
+                for cname, ldap_attributes, ctrls in result_data:
+                    state_ctrls = [c for c in ctrls if c.controlType == SyncStateControl.controlType]
+                    if not state_ctrls:
+                        continue
+
+                    state = state_ctrls[0]
+                    if state.state == 'present':
+                        present.add(state.entryUUID)
+                    elif state.state == 'delete':
+                        yield state.entryUUID, None
+                    else:
+                        present.add(state.entryUUID)
+                        yield state.entryUUID, (cname, packer.pack(ldap_attributes))
+                    if state.cookie is not None:
+                        self.cookie = state.cookie
+
+            elif result_type == ldap.RES_INTERMEDIATE:
+                for name, value, ctrls in result_data:
+                    if name != SyncInfoMessage.responseName:
+                        continue
+
+                    info = SyncInfoMessage(value)
+                    if info.newcookie is not None:
+                        self.cookie = info.newcookie
+                    elif info.refreshPresent is not None:
+                        present_phase = True
+                        self.cookie = info.refreshPresent.get('cookie', self.cookie)
+                    elif info.refreshDelete is not None:
+                        self.cookie = info.refreshDelete.get('cookie', self.cookie)
+                    elif info.syncIdSet is not None:
+                        if info.syncIdSet['refreshDeletes']:
+                            for identifier in info.syncIdSet['syncUUIDs']:
+                                yield identifier, None
+                        else:
+                            present.update(info.syncIdSet['syncUUIDs'])
+                        self.cookie = info.syncIdSet.get('cookie', self.cookie)
+
+        if present_phase:
+            self.present = present
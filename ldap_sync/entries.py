@@ -0,0 +1,64 @@
+from collections.abc import Mapping
+
+
+class Attributes(Mapping):
+    """
+    The attributes of a search result entry, stored compactly. Values are
+    kept in a tuple ordered by an index of attribute names shared by every
+    entry of a search, and a single value is stored without a list. Each
+    attribute reads as a tuple of its values, like python-ldap's lists.
+    """
+    __slots__ = ('index', 'values')
+
+    def __init__(self, index, values):
+        self.index = index
+        self.values = values
+
+    def __getitem__(self, name):
+        position = self.index[name]
+        value = self.values[position] if position < len(self.values) else None
+        if value is None:
+            raise KeyError(name)
+        return value if isinstance(value, tuple) else (value,)
+
+    def __iter__(self):
+        values = self.values
+        return (name for name, position in list(self.index.items())
+                if position < len(values) and values[position] is not None)
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not None)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class EntryPacker(object):
+    """
+    Convert the entries of one search into Attributes as they are received,
+    dropping any attributes that were not requested. Ranged values such as
+    ``member;range=0-1499`` are kept for requested attributes.
+    """
+    def __init__(self, attrlist=None):
+        self.wanted = None
+        if attrlist is not None and '*' not in attrlist:
+            self.wanted = set(name.lower() for name in attrlist)
+        self.index = {}
+
+    def pack(self, ldap_attributes):
+        index = self.index
+        values = [None] * len(index)
+        for name, attr_values in ldap_attributes.items():
+            if self.wanted is not None and name.split(';', 1)[0].lower() not in self.wanted:
+                continue
+            position = index.get(name)
+            if position is None:
+                position = index[name] = len(index)
+                values.append(None)
+            values[position] = attr_values[0] if len(attr_values) == 1 else tuple(attr_values)
+        return Attributes(index, tuple(values))
+
+    def pack_page(self, entries):
+        """Return a page of search results with the attributes of each entry packed."""
+        return [(cname, self.pack(ldap_attributes)) if isinstance(ldap_attributes, dict) else (cname, ldap_attributes)
+                for cname, ldap_attributes in entries]
@@ -0,0 +1,56 @@
+import hashlib
+
+from ldap_sync.models import UserFingerprint
+
+
+class FingerprintStore(object):
+    """
+    Base class for stores keeping a fingerprint of each user's LDAP entry,
+    allowing entries that have not changed since the previous run to be
+    skipped. Subclasses implement get_many() and set_many().
+    """
+    def __init__(self, settings, prefix):
+        self.settings = settings
+        self.prefix = prefix
+        # Changing the attribute mapping or callbacks changes every
+        # fingerprint, so all users are processed again after a change
+        self.salt = repr((settings.user_attribute_map.signature, settings.USER_EXTRA_ATTRIBUTES,
+                          settings.USER_CALLBACKS)).encode('utf-8')
+
+    def fingerprint(self, ldap_attributes):
+        """Return a stable hash of an entry's attributes."""
+        digest = hashlib.sha1(self.salt)
+        for name in sorted(ldap_attributes):
+            digest.update(repr((name, list(ldap_attributes[name]))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_many(self, usernames):
+        """Return a mapping of username to stored fingerprint."""
+        raise NotImplementedError
+
+    def set_many(self, fingerprints):
+        """Store a mapping of username to fingerprint."""
+        raise NotImplementedError
+
+
+class DatabaseFingerprintStore(FingerprintStore):
+    """Keep fingerprints in the UserFingerprint table."""
+    def get_many(self, usernames):
+        fingerprints = UserFingerprint.objects.filter(prefix=self.prefix, username__in=list(usernames))
+        return dict(fingerprints.values_list('username', 'fingerprint'))
+
+    def set_many(self, fingerprints):
+        fingerprints = dict(fingerprints)
+        existing = UserFingerprint.objects.filter(prefix=self.prefix, username__in=list(fingerprints))
+        updated = []
+        for entry in existing:
+            fingerprint = fingerprints.pop(entry.username)
+            if entry.fingerprint != fingerprint:
+                entry.fingerprint = fingerprint
+                updated.append(entry)
+
+        UserFingerprint.objects.bulk_update(updated, ['fingerprint'])
+        UserFingerprint.objects.bulk_create([
+            UserFingerprint(prefix=self.prefix, username=username, fingerprint=fingerprint)
+            for username, fingerprint in fingerprints.items()
+        ])
@@ -0,0 +1,47 @@
+from collections.abc import Mapping
+
+from ldap.filter import escape_filter_chars
+
+from ldap_sync.utils import filter_key
+
+
+class HighWaterMark(object):
+    """
+    Track the highest value of an incremental attribute, such as
+    modifyTimestamp or uSNChanged, seen across search results.
+    """
+    def __init__(self, attribute, value=None):
+        self.attribute = attribute
+        self.value = value
+
+    @staticmethod
+    def key(filterstr, attribute):
+        """Return a state key identifying a filter and incremental attribute."""
+        return filter_key('users:watermark', filterstr, attribute)
+
+    @staticmethod
+    def _ordering(value):
+        # Compare counters such as uSNChanged numerically; generalized
+        # time values such as modifyTimestamp sort correctly as strings
+        if value.isdigit():
+            return (0, int(value), value)
+        return (1, 0, value)
+
+    def filter(self, filterstr):
+        """Restrict a filter to entries at or above the high-water mark."""
+        if not filterstr.startswith('('):
+            filterstr = '(%s)' % filterstr
+        return '(&%s(%s>=%s))' % (filterstr, self.attribute, escape_filter_chars(self.value))
+
+    def track(self, ldap_entries):
+        """Pass entries through while recording the highest attribute value."""
+        for entry in ldap_entries:
+            cname, ldap_attributes = entry
+            if isinstance(ldap_attributes, Mapping):
+                for value in ldap_attributes.get(self.attribute, []):
+                    self.update(value.decode('utf-8'))
+            yield entry
+
+    def update(self, value):
+        if self.value is None or self._ordering(value) > self._ordering(self.value):
+            self.value = value
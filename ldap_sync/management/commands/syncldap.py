@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
+from ldap_sync.runs import SyncLocked
 from ldap_sync.sync import SyncLDAP
 
 
@@ -7,7 +9,29 @@ class Command(BaseCommand):
     can_import_settings = True
     help = 'Synchronize users and groups from an authoritative LDAP server'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', dest='full',
+                            help='Synchronize all users, ignoring any stored incremental high-water mark')
+        parser.add_argument('--stats', action='store_true', dest='stats',
+                            help='Print counts and timings for the synchronization')
+        parser.add_argument('--dry-run', '--plan', action='store_true', dest='dry_run',
+                            help='Print the changes a synchronization would make without writing them')
+        parser.add_argument('--record', metavar='PATH', dest='record',
+                            help='Write the LDAP search results to a snapshot file instead of synchronizing')
+        parser.add_argument('--snapshot', metavar='PATH', dest='snapshot',
+                            help='Synchronize from a snapshot file instead of the LDAP server')
+
     def handle(self, *args, **options):
-        sync_ldap = SyncLDAP()
-        sync_ldap.sync_groups()
-        sync_ldap.sync_users()
+        sync_ldap = SyncLDAP(snapshot=options['snapshot'])
+        if options['record']:
+            sync_ldap.record(options['record'])
+            return
+        if options['dry_run']:
+            self.stdout.write(str(sync_ldap.plan()))
+            return
+        try:
+            stats = sync_ldap.sync(full=options['full'])
+        except SyncLocked as e:
+            raise CommandError(e)
+        if options['stats']:
+            self.stdout.write(str(stats))
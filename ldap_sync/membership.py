@@ -0,0 +1,115 @@
+import logging
+
+from django.contrib.auth.models import Group
+
+from ldap_sync.utils import chunked
+
+
+logger = logging.getLogger(__name__)
+
+
+class GroupMemberships(object):
+    """
+    Collect group memberships from LDAP entries as groups and users are
+    synchronized, then apply them to the user model's groups relation by
+    diffing against its through table.
+    """
+    # The run's RunLock, refreshed as memberships are applied
+    lock = None
+
+    def __init__(self, settings, ldap_search):
+        self.settings = settings
+        self.ldap = ldap_search
+        self.group_dns = {}
+        self.group_members = {}
+        self.user_dns = {}
+        self.user_groups = {}
+        self.users_complete = False
+
+    def add_group(self, cname, groupname, ldap_attributes):
+        self.group_dns[cname.lower()] = groupname
+        if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'member':
+            members = self.ldap.ranged_values(cname, ldap_attributes, 'member')
+            self.group_members[groupname] = [dn.decode('utf-8').lower() for dn in members]
+
+    def add_user(self, cname, username, ldap_attributes):
+        self.user_dns[cname.lower()] = username
+        if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'memberOf':
+            groups = self.ldap.ranged_values(cname, ldap_attributes, 'memberOf')
+            self.user_groups[username] = [dn.decode('utf-8').lower() for dn in groups]
+
+    def desired_memberships(self, group_ids, user_ids):
+        """Return the set of (user_id, group_id) pairs present in LDAP."""
+        desired = set()
+
+        if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'member':
+            for groupname, member_dns in self.group_members.items():
+                group_id = group_ids.get(groupname.lower())
+                for dn in member_dns:
+                    user_id = user_ids.get(self.user_dns.get(dn))
+                    if group_id is not None and user_id is not None:
+                        desired.add((user_id, group_id))
+        else:
+            for username, group_dns in self.user_groups.items():
+                user_id = user_ids.get(username)
+                for dn in group_dns:
+                    group_id = group_ids.get(self.group_dns.get(dn, '').lower())
+                    if group_id is not None and user_id is not None:
+                        desired.add((user_id, group_id))
+
+        return desired
+
+    def _refresh(self):
+        if self.lock is not None:
+            self.lock.refresh()
+
+    def apply(self):
+        """
+        Add and remove rows in the groups through table so memberships of
+        the synchronized groups match LDAP. Only groups found by the group
+        search are managed; memberships of other local groups are untouched.
+        """
+        if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'member' and not self.users_complete:
+            logger.info("Group memberships from member attributes require a full user synchronization")
+            return
+
+        groupnames = set(name.lower() for name in self.group_dns.values())
+        group_ids = {}
+        for name, pk in Group.objects.values_list(self.settings.GROUPNAME_FIELD, 'pk').iterator():
+            if name.lower() in groupnames:
+                group_ids[name.lower()] = pk
+
+        user_ids = {}
+        usernames = set(self.user_dns.values())
+        for username, pk in self.settings.model.objects.values_list(self.settings.USERNAME_FIELD, 'pk').iterator():
+            if username.lower() in usernames:
+                user_ids[username.lower()] = pk
+
+        desired = self.desired_memberships(group_ids, user_ids)
+
+        # The through table's foreign keys are named after the user model
+        relation = self.settings.model.groups
+        through = relation.through
+        user_field = relation.field.m2m_field_name() + '_id'
+        group_field = relation.field.m2m_reverse_field_name() + '_id'
+        existing = {}
+        for chunk in chunked(group_ids.values(), self.settings.BATCH_SIZE):
+            self._refresh()
+            memberships = through.objects.filter(**{group_field + '__in': chunk})
+            if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'memberOf' and not self.users_complete:
+                # Only the memberships of users seen by a partial
+                # synchronization are known, so leave all others alone
+                memberships = memberships.filter(**{user_field + '__in': list(user_ids.values())})
+            for pk, user_id, group_id in memberships.values_list('pk', user_field, group_field).iterator():
+                existing[(user_id, group_id)] = pk
+
+        added = [through(**{user_field: user_id, group_field: group_id}) for user_id, group_id in desired
+                 if (user_id, group_id) not in existing]
+        through.objects.bulk_create(added, batch_size=self.settings.BATCH_SIZE)
+
+        removed = [pk for membership, pk in existing.items() if membership not in desired]
+        for chunk in chunked(removed, self.settings.BATCH_SIZE):
+            self._refresh()
+            through.objects.filter(pk__in=chunk).delete()
+
+        logger.debug("Added %d and removed %d group memberships" % (len(added), len(removed)))
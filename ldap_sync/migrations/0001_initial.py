@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=100)),
+                ('key', models.CharField(max_length=255)),
+                ('value', models.TextField()),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('prefix', 'key')},
+            },
+        ),
+    ]
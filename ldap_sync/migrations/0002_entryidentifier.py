@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldap_sync', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntryIdentifier',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=100)),
+                ('identifier', models.CharField(max_length=64)),
+                ('username', models.CharField(max_length=255)),
+            ],
+            options={
+                'unique_together': {('prefix', 'identifier')},
+            },
+        ),
+    ]
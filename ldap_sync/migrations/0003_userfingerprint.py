@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldap_sync', '0002_entryidentifier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=100)),
+                ('username', models.CharField(max_length=255)),
+                ('fingerprint', models.CharField(max_length=40)),
+            ],
+            options={
+                'unique_together': {('prefix', 'username')},
+            },
+        ),
+    ]
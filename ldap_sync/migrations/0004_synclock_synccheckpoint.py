@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldap_sync', '0003_userfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=100, unique=True)),
+                ('owner', models.CharField(max_length=32)),
+                ('heartbeat', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=100)),
+                ('key', models.CharField(max_length=255)),
+                ('run', models.CharField(max_length=32)),
+                ('usernames', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['prefix', 'key'], name='ldap_sync_s_prefix_02d266_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,102 @@
+import json
+
+from django.db import models
+
+
+class SyncStateManager(models.Manager):
+    def get_value(self, prefix, key, default=None):
+        """Return the decoded value stored for a settings prefix and key."""
+        try:
+            state = self.get(prefix=prefix, key=key)
+        except self.model.DoesNotExist:
+            return default
+        return json.loads(state.value)
+
+    def set_value(self, prefix, key, value):
+        """Store a JSON serializable value for a settings prefix and key."""
+        self.update_or_create(prefix=prefix, key=key, defaults={'value': json.dumps(value)})
+
+
+class SyncState(models.Model):
+    """
+    Persistent synchronization state, such as high-water marks, kept
+    between runs for each settings prefix.
+    """
+    prefix = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    value = models.TextField()
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = SyncStateManager()
+
+    class Meta:
+        unique_together = ('prefix', 'key')
+
+    def __str__(self):
+        return '%s%s' % (self.prefix, self.key)
+
+
+class EntryIdentifier(models.Model):
+    """
+    Map the server assigned identifier of a synchronized LDAP entry, such
+    as objectGUID or entryUUID, to its local username so delete
+    notifications carrying only the identifier can be resolved.
+    """
+    prefix = models.CharField(max_length=100)
+    identifier = models.CharField(max_length=64)
+    username = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('prefix', 'identifier')
+
+    def __str__(self):
+        return self.identifier
+
+
+class UserFingerprint(models.Model):
+    """
+    A hash of the LDAP attributes last synchronized for a user, used to
+    skip entries that have not changed since the previous run.
+    """
+    prefix = models.CharField(max_length=100)
+    username = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = ('prefix', 'username')
+
+    def __str__(self):
+        return self.username
+
+
+class SyncLock(models.Model):
+    """
+    A lock held by the running synchronization for a settings prefix. A
+    lock whose heartbeat has not been refreshed within the lock timeout is
+    considered abandoned and may be taken over.
+    """
+    prefix = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=32)
+    heartbeat = models.DateTimeField()
+
+    def __str__(self):
+        return self.prefix
+
+
+class SyncCheckpoint(models.Model):
+    """
+    The usernames synchronized by one committed batch of a full user
+    synchronization, allowing an interrupted run to resume without
+    processing those users again.
+    """
+    prefix = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    run = models.CharField(max_length=32)
+    usernames = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['prefix', 'key'])]
+
+    def __str__(self):
+        return '%s%s' % (self.prefix, self.key)
@@ -0,0 +1,76 @@
+from collections.abc import Mapping
+
+from django.contrib.auth.models import Group
+
+
+class SyncPlan(object):
+    """
+    The changes a synchronization would make, computed by comparing LDAP
+    entries against a snapshot of local users and groups loaded with one
+    query each. Nothing is written, and callbacks are not run, so changes
+    made by callbacks are not included.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.created_groups = []
+        self.created_users = {}
+        self.updated_users = {}
+        self.removed_users = []
+        self.users = None
+        self.groupnames = None
+
+    def __str__(self):
+        lines = ['+ group %s' % groupname for groupname in self.created_groups]
+        lines.extend('+ user %s' % username for username in sorted(self.created_users))
+        for username, changes in sorted(self.updated_users.items()):
+            lines.append('~ user %s: %s' % (username, ', '.join(
+                '%s %r -> %r' % (field, old, new) for field, (old, new) in sorted(changes.items()))))
+        lines.extend('- user %s' % username for username in sorted(self.removed_users))
+        lines.append('%d groups to create, %d users to create, %d users to update, %d users to remove' % (
+            len(self.created_groups), len(self.created_users), len(self.updated_users), len(self.removed_users)))
+        return '\n'.join(lines)
+
+    def load(self):
+        """Load a snapshot of the local state the plan is compared against."""
+        fields = self.settings.user_attribute_map.fields
+        self.users = {}
+        for values in self.settings.model.objects.values_list(self.settings.USERNAME_FIELD, *fields).iterator():
+            self.users[values[0].lower()] = dict(zip(fields, values[1:]))
+        self.groupnames = set(name.lower() for name in
+                              Group.objects.values_list(self.settings.GROUPNAME_FIELD, flat=True).iterator())
+
+    def diff_groups(self, ldap_groups):
+        for cname, ldap_attributes in ldap_groups:
+            if not isinstance(ldap_attributes, Mapping):
+                continue
+
+            groupname = self.settings.group_attribute_map(ldap_attributes)[self.settings.GROUPNAME_FIELD]
+            if groupname.lower() not in self.groupnames:
+                self.groupnames.add(groupname.lower())
+                self.created_groups.append(groupname)
+
+    def diff_users(self, ldap_users, remove=True):
+        """
+        Compare LDAP users against the snapshot. Removed users are only
+        planned when the removed user callbacks would run for them.
+        """
+        seen = set()
+        for cname, ldap_attributes in ldap_users:
+            if not isinstance(ldap_attributes, Mapping):
+                continue
+
+            defaults = self.settings.user_attribute_map(ldap_attributes)
+            username = defaults[self.settings.USERNAME_FIELD].lower()
+            seen.add(username)
+
+            current = self.users.get(username)
+            if current is None:
+                self.created_users[username] = defaults
+                continue
+
+            changes = {field: (current[field], value) for field, value in defaults.items() if current[field] != value}
+            if changes:
+                self.updated_users[username] = changes
+
+        if remove and self.settings.REMOVED_USER_CALLBACKS:
+            self.removed_users = [username for username in self.users if username not in seen]
@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+
+import ldap
+
+
+logger = logging.getLogger(__name__)
+
+
+class Server(object):
+    """Health and load information for a single LDAP server."""
+    def __init__(self, uri):
+        self.uri = uri
+        self.idle = []
+        self.in_use = 0
+        self.latency = 0.0
+        self.failed_at = None
+
+    def available(self, retry_delay):
+        return self.failed_at is None or time.monotonic() - self.failed_at >= retry_delay
+
+    def record_latency(self, seconds):
+        """Keep a moving average of response times."""
+        self.latency = seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+
+
+class ConnectionPool(object):
+    """
+    A pool of bound connections to one or more replicas of an LDAP server.
+    Connections are handed to the healthy server with the fewest active
+    connections and the fastest responses, and are kept for reuse once
+    released. Pools are shared by every search using the same servers and
+    credentials, so connections are reused across synchronizations and
+    Celery tasks running in the same process.
+    """
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, uris, who, cred, size=4, retry_delay=60):
+        self.servers = [Server(uri) for uri in uris]
+        self.who = who
+        self.cred = cred
+        self.size = size
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_settings(cls, settings):
+        """Return the shared pool for the servers and credentials in settings."""
+        key = (tuple(settings.uris), settings.BASE_USER, settings.BASE_PASS)
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(settings.uris, settings.BASE_USER, settings.BASE_PASS,
+                                      size=settings.POOL_SIZE, retry_delay=settings.SERVER_RETRY_DELAY)
+            return cls._pools[key]
+
+    @classmethod
+    def close_all(cls):
+        """Unbind the idle connections of every pool and forget them."""
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                pool.close()
+            cls._pools.clear()
+
+    def acquire(self):
+        """
+        Return a (server, connection) tuple for the best available server,
+        binding a new connection if none are idle. Servers that cannot be
+        reached are marked as failed and the next best server is tried.
+        """
+        tried = set()
+        error = None
+
+        while True:
+            with self.lock:
+                candidates = [server for server in self.servers if server.uri not in tried]
+                if not candidates:
+                    raise error or ldap.SERVER_DOWN({'desc': 'No LDAP servers configured'})
+                healthy = [server for server in candidates if server.available(self.retry_delay)]
+                # If every server has failed recently, try them anyway
+                server = min(healthy or candidates, key=lambda server: (server.in_use, server.latency))
+                server.in_use += 1
+                conn = server.idle.pop() if server.idle else None
+
+            if conn is not None:
+                return server, conn
+
+            try:
+                return server, self._bind(server.uri)
+            except ldap.LDAPError as e:
+                error = e
+                tried.add(server.uri)
+                self.release(server, None, failed=True)
+
+    def release(self, server, conn, failed=False):
+        """
+        Return a connection to the pool. Connections that failed are
+        discarded and their server is avoided until the retry delay passes.
+        """
+        with self.lock:
+            server.in_use -= 1
+            if failed:
+                server.failed_at = time.monotonic()
+            elif conn is not None:
+                server.failed_at = None
+                if len(server.idle) < self.size:
+                    server.idle.append(conn)
+                    conn = None
+
+        if conn is not None:
+            self._unbind(conn)
+
+    def close(self):
+        with self.lock:
+            connections = [conn for server in self.servers for conn in server.idle]
+            for server in self.servers:
+                server.idle = []
+        for conn in connections:
+            self._unbind(conn)
+
+    def _bind(self, uri):
+        ldap.set_option(ldap.OPT_REFERRALS, 0)
+        l = ldap.initialize(uri)
+        l.protocol_version = ldap.VERSION3
+        try:
+            l.simple_bind_s(self.who, self.cred)
+        except ldap.LDAPError as e:
+            logger.error("Error connecting to %s: %s" % (uri, e))
+            raise
+        return l
+
+    def _unbind(self, conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
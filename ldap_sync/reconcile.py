@@ -0,0 +1,88 @@
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class MergeJoin(object):
+    """
+    Walk the local users in username order alongside a user search the
+    server sorted on the username attribute, so neither side is held in
+    memory. Local users are read a chunk per query, paginated on the
+    username so each query uses its index. Each batch of search results is
+    matched against the local users in its range, and local users passed
+    over without having been returned are collected for removal.
+
+    Usernames are compared lowercased, so the server's ordering rule and
+    the database collation must both order usernames case-insensitively.
+    Both sides are checked to be in the order compared here; if either is
+    not, users cannot be matched or removed this way for the run.
+    """
+    def __init__(self, settings, keep=(), chunk_size=None):
+        self.settings = settings
+        self.keep = keep
+        self.chunk_size = chunk_size or settings.BATCH_SIZE
+        self.ordered = True
+        self.removed = []
+        self.previous = ''
+        self.local = self._local_users()
+        self.current = next(self.local, None)
+
+    def _local_users(self):
+        """Yield the lowercased username and user of every local user in order, a chunk per query."""
+        field = self.settings.USERNAME_FIELD
+        users = self.settings.model.objects.order_by(field)
+        last = None
+        while True:
+            chunk = users
+            if last is not None:
+                chunk = users.filter(**{field + '__gt': last})
+            chunk = list(chunk[:self.chunk_size])
+            for user in chunk:
+                username = getattr(user, field)
+                if last is not None and username.lower() < last.lower():
+                    self._unordered('local users')
+                last = username
+                yield username.lower(), user
+            if len(chunk) < self.chunk_size:
+                return
+
+    def _unordered(self, side):
+        if self.ordered:
+            logger.error("The %s are not in case-insensitive username order, so users cannot be matched in "
+                         "order; check the ordering rule for %s and the database collation" %
+                         (side, self.settings.username_attribute))
+        self.ordered = False
+
+    def advance(self, usernames):
+        """
+        Consume the local users up to the last username of a batch of search
+        results, given in the order they were returned. Return a mapping of
+        lowercased username to user for the batch's existing users, or None
+        if either side is not in order. Other local users in that range are
+        removed unless they are in ``keep``.
+        """
+        for username in usernames:
+            if username < self.previous:
+                self._unordered('search results')
+            self.previous = max(self.previous, username)
+
+        batch = set(usernames)
+        existing = {}
+        while self.ordered and self.current is not None and self.current[0] <= self.previous:
+            username, user = self.current
+            if username in batch:
+                existing[username] = user
+            elif username not in self.keep:
+                self.removed.append(user.pk)
+            self.current = next(self.local, None)
+        return existing if self.ordered else None
+
+    def finish(self):
+        """Return the primary keys of the users to remove, or None if they cannot be detected."""
+        while self.ordered and self.current is not None:
+            username, user = self.current
+            if username not in self.keep:
+                self.removed.append(user.pk)
+            self.current = next(self.local, None)
+        return self.removed if self.ordered else None
@@ -0,0 +1,111 @@
+import json
+import logging
+import uuid
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.db import transaction
+from django.utils import timezone
+
+from ldap_sync.models import SyncCheckpoint
+from ldap_sync.models import SyncLock
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncLocked(Exception):
+    """Raised when another synchronization holds the lock for a settings prefix."""
+
+
+class RunLock(object):
+    """
+    A database lock preventing concurrent synchronizations for a settings
+    prefix. The holder refreshes its heartbeat as it makes progress, and a
+    lock that has not been refreshed within ``timeout`` seconds is taken
+    over, so a run that died without releasing it cannot block later runs.
+    A lock held by another process is refreshed or released by creating a
+    RunLock with its ``owner``.
+    """
+    # Refresh the heartbeat at most this often, in seconds
+    refresh_interval = 60
+
+    def __init__(self, prefix, timeout, owner=None):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.owner = owner or uuid.uuid4().hex
+        self.refreshed = None
+
+    def acquire(self):
+        """Take the lock, returning False if another run holds it."""
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                SyncLock.objects.create(prefix=self.prefix, owner=self.owner, heartbeat=now)
+        except IntegrityError:
+            # Only take over an abandoned lock, atomically, in case another
+            # run is doing the same
+            expired = now - timedelta(seconds=self.timeout)
+            abandoned = SyncLock.objects.filter(prefix=self.prefix, heartbeat__lt=expired)
+            if not abandoned.update(owner=self.owner, heartbeat=now):
+                return False
+            logger.warning("Took over abandoned synchronization lock for %s" % self.prefix)
+        self.refreshed = now
+        return True
+
+    def refresh(self):
+        """
+        Refresh the heartbeat, raising SyncLocked if the lock was taken over
+        by another run so this run stops rather than continuing alongside it.
+        """
+        now = timezone.now()
+        if self.refreshed is None or now - self.refreshed >= timedelta(seconds=self.refresh_interval):
+            if not SyncLock.objects.filter(prefix=self.prefix, owner=self.owner).update(heartbeat=now):
+                raise SyncLocked("The synchronization lock for %s was taken over by another run" % self.prefix)
+            self.refreshed = now
+
+    def release(self):
+        SyncLock.objects.filter(prefix=self.prefix, owner=self.owner).delete()
+
+
+class Checkpoint(object):
+    """
+    Record the usernames synchronized by each committed batch of a full
+    user synchronization. If the run is interrupted, the next run resumes
+    by skipping those users, and still counts them as seen when removed
+    users are reconciled.
+    """
+    def __init__(self, prefix, key, run):
+        self.prefix = prefix
+        self.key = key
+        self.run = run
+
+    @property
+    def checkpoints(self):
+        return SyncCheckpoint.objects.filter(prefix=self.prefix, key=self.key)
+
+    def load(self, max_age):
+        """
+        Return the usernames completed by an interrupted run. Checkpoints
+        older than ``max_age`` seconds are discarded, since the entries they
+        skip may have changed since.
+        """
+        self.checkpoints.filter(created__lt=timezone.now() - timedelta(seconds=max_age)).delete()
+        usernames = set()
+        runs = set()
+        for run, batch in self.checkpoints.values_list('run', 'usernames').iterator():
+            runs.add(run)
+            usernames.update(json.loads(batch))
+        if usernames:
+            logger.info("Resuming interrupted synchronization %s with %d users complete" % (
+                ', '.join(sorted(runs)), len(usernames)))
+        return usernames
+
+    def save(self, usernames):
+        """Record a batch of usernames; call within the batch's transaction."""
+        if usernames:
+            SyncCheckpoint.objects.create(prefix=self.prefix, key=self.key, run=self.run,
+                                          usernames=json.dumps(sorted(usernames)))
+
+    def clear(self):
+        self.checkpoints.delete()
@@ -1,17 +1,48 @@
 import logging
+import threading
+import time
+from collections.abc import Mapping
 
 import ldap
 from ldap.controls import SimplePagedResultsControl
+from ldap.controls.sss import SSSRequestControl
+from ldap.filter import escape_filter_chars
+
+from ldap_sync.delta import DirSyncSearch
+from ldap_sync.delta import SyncReplSearch
+from ldap_sync.entries import EntryPacker
+from ldap_sync.pool import ConnectionPool
+from ldap_sync.utils import interleave
+from ldap_sync.utils import prefetch
 
 
 logger = logging.getLogger(__name__)
 
 
+def entry_size(entry):
+    """Return the approximate size in bytes of a search result entry."""
+    cname, ldap_attributes = entry
+    if not isinstance(ldap_attributes, Mapping):
+        return 0
+    return len(cname) + sum(len(name) + sum(len(value) for value in values)
+                            for name, values in ldap_attributes.items())
+
+
 class LDAPSearch(object):
     _conn = None
+    _server = None
+
+    # Searches are answered by a server, so change tracking is available
+    live = True
 
-    def __init__(self, settings):
+    # Errors indicating a server is unavailable, after which a search is
+    # retried on another server
+    RETRY_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT, ldap.UNAVAILABLE, ldap.BUSY)
+
+    def __init__(self, settings, stats=None):
         self.settings = settings
+        self.stats = stats
+        self.pool = ConnectionPool.for_settings(settings)
 
     def __del__(self):
         self._unbind()
@@ -19,48 +50,198 @@ class LDAPSearch(object):
     @property
     def conn(self):
         if self._conn is None:
-            self._conn = self._bind()
+            self._server, self._conn = self.pool.acquire()
         return self._conn
 
-    def _bind(self):
-        ldap.set_option(ldap.OPT_REFERRALS, 0)
-        l = ldap.initialize(self.settings.URI)
-        l.protocol_version = ldap.VERSION3
-        try:
-            l.simple_bind_s(self.settings.BASE_USER, self.settings.BASE_PASS)
-        except ldap.LDAPError as e:
-            logger.error("Error connecting to %s: %s" % (self.settings.URI, e))
-            raise
-        return l
-
-    def _unbind(self):
+    def _unbind(self, failed=False):
+        """Return the connection to the pool, discarding it if it failed."""
         if self._conn is not None:
-            self.conn.unbind_s()
+            self.pool.release(self._server, self._conn, failed=failed)
             self._conn = None
+            self._server = None
 
     def search(self, filterstr, attrlist):
         """Query the configured LDAP server."""
         return self._paged_search_ext_s(self.settings.BASE, ldap.SCOPE_SUBTREE, filterstr=filterstr,
                                         attrlist=attrlist, page_size=self.settings.PAGE_SIZE)
 
+    def iter_search(self, filterstr, attrlist, sharded=False, base=None, sort=None):
+        """
+        Query the configured LDAP server, yielding entries as each page of
+        results is received instead of waiting for the complete result set.
+        """
+        for page in self.search_pages(filterstr, attrlist, sharded=sharded, base=base, sort=sort):
+            for entry in page:
+                yield entry
+
+    def search_pages(self, filterstr, attrlist, sharded=False, base=None, sort=None):
+        """
+        Query the configured LDAP server, yielding each page of results. If
+        PREFETCH_PAGES is set, pages are requested on a background thread so
+        the next page is fetched while the current one is being processed.
+        If ``sharded`` is set and shards are configured, the search is split
+        into shards that run concurrently on separate connections. The
+        configured BASE is searched unless another ``base`` is given. If
+        ``sort`` names an attribute, the server sorts the results by it using
+        the server side sort control; sorted searches are never sharded.
+        """
+        if sort is None and sharded and (self.settings.SEARCH_SHARDS or self.settings.SHARD_ATTRIBUTE):
+            return self._sharded_search_pages(filterstr, attrlist)
+
+        pages = self._paged_search_ext(base or self.settings.BASE, ldap.SCOPE_SUBTREE, filterstr=filterstr,
+                                       attrlist=attrlist, serverctrls=self._sort_controls(sort),
+                                       page_size=self.settings.PAGE_SIZE)
+        if self.settings.PREFETCH_PAGES:
+            pages = prefetch(pages, self.settings.PREFETCH_PAGES)
+        return pages
+
+    def _sort_controls(self, sort):
+        """Return the server controls requesting results sorted by an attribute, if any."""
+        if sort is None:
+            return None
+        # Critical, so a server that cannot sort fails the search rather
+        # than returning unsorted results
+        return [SSSRequestControl(criticality=True, ordering_rules=[sort])]
+
+    def shards(self, filterstr):
+        """
+        Split a search into (base, filterstr) shards, by the configured
+        search bases and by prefixes of the configured shard attribute. A
+        final prefix shard matches every entry not covered by the others.
+        """
+        if not filterstr.startswith('('):
+            filterstr = '(%s)' % filterstr
+
+        filters = [filterstr]
+        if self.settings.SHARD_ATTRIBUTE:
+            prefixes = ['(%s=%s*)' % (self.settings.SHARD_ATTRIBUTE, escape_filter_chars(prefix))
+                        for prefix in self.settings.SHARD_PREFIXES]
+            filters = ['(&%s%s)' % (filterstr, prefix) for prefix in prefixes]
+            filters.append('(&%s(!(|%s)))' % (filterstr, ''.join(prefixes)))
+
+        bases = self.settings.SEARCH_SHARDS or [self.settings.BASE]
+        return [(base, shard_filter) for base in bases for shard_filter in filters]
+
+    def _sharded_search_pages(self, filterstr, attrlist):
+        """
+        Run each shard of a search on a pool of SEARCH_THREADS threads, each
+        with its own bound connection, yielding pages as they arrive. Entries
+        returned by more than one shard are only yielded once.
+        """
+        local = threading.local()
+
+        def shard_pages(base, shard_filter):
+            if not hasattr(local, 'search'):
+                # Each worker thread binds one connection for all its shards
+                local.search = LDAPSearch(self.settings, stats=self.stats)
+            for page in local.search._paged_search_ext(base, ldap.SCOPE_SUBTREE, filterstr=shard_filter,
+                                                       attrlist=attrlist, page_size=self.settings.PAGE_SIZE):
+                yield page
+
+        shards = [shard_pages(base, shard_filter) for base, shard_filter in self.shards(filterstr)]
+        buffer_size = self.settings.PREFETCH_PAGES or self.settings.SEARCH_THREADS
+        seen = set()
+
+        for page in interleave(shards, buffer_size, workers=self.settings.SEARCH_THREADS):
+            entries = []
+            for cname, ldap_attributes in page:
+                if isinstance(ldap_attributes, Mapping):
+                    if cname.lower() in seen:
+                        continue
+                    seen.add(cname.lower())
+                entries.append((cname, ldap_attributes))
+            yield entries
+
+    def ranged_values(self, dn, ldap_attributes, attribute):
+        """
+        Return every value of a multi-valued attribute. Active Directory
+        returns large attributes such as member in ranges, e.g.
+        ``member;range=0-1499``, requiring follow-up reads for the rest.
+        """
+        values = list(ldap_attributes.get(attribute, []))
+        prefix = attribute.lower() + ';range='
+
+        while True:
+            ranged = [name for name in ldap_attributes if name.lower().startswith(prefix)]
+            if not ranged:
+                break
+
+            values.extend(ldap_attributes[ranged[0]])
+            start, end = ranged[0][len(prefix):].split('-')
+            if end == '*':
+                break
+
+            next_range = '%s;range=%d-*' % (attribute, int(end) + 1)
+            results = self.conn.search_s(dn, ldap.SCOPE_BASE, attrlist=[next_range])
+            ldap_attributes = results[0][1] if results else {}
+
+        return values
+
+    def delta_search(self, cookie=None):
+        """
+        Return a change tracking search using the configured DELTA_SYNC
+        control, resuming from a cookie stored by a previous run.
+        """
+        if self.settings.DELTA_SYNC == 'dirsync':
+            return DirSyncSearch(self, cookie)
+        return SyncReplSearch(self, cookie)
+
     def _paged_search_ext_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
                             serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0, page_size=10):
         """
         Behaves similarly to LDAPObject.search_ext_s() but internally uses the
         simple paged results control to retrieve search results in chunks.
+        """
+        results = []
+        for page in self._paged_search_ext(base, scope, filterstr=filterstr, attrlist=attrlist, attrsonly=attrsonly,
+                                           serverctrls=serverctrls, clientctrls=clientctrls, timeout=timeout,
+                                           sizelimit=sizelimit, page_size=page_size):
+            results.extend(page)
+        return results
+
+    def _paged_search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                          serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0, page_size=10):
+        """
+        Generator using the simple paged results control to retrieve search
+        results in chunks, yielding each page as soon as it is received so
+        memory use is bounded by the page size rather than the result size.
 
         Taken from the python-ldap paged_search_ext_s.py demo, showing how to use
         the paged results control: https://bitbucket.org/jaraco/python-ldap/
         """
         request_ctrl = SimplePagedResultsControl(True, size=page_size, cookie='')
-        results = []
+        packer = EntryPacker(attrlist)
+        retries = self.settings.SEARCH_RETRIES
+        # Track returned entries so a search restarted after a failure does
+        # not return them again; this holds every DN returned, so it is only
+        # done when retries are enabled
+        returned_dns = set() if retries else None
 
         while True:
-            msgid = self.conn.search_ext(base, scope, filterstr=filterstr, attrlist=attrlist, attrsonly=attrsonly,
-                                         serverctrls=(serverctrls or []) + [request_ctrl], clientctrls=clientctrls,
-                                         timeout=timeout, sizelimit=sizelimit)
-            result_type, result_data, result_msgid, result_ctrls = self.conn.result3(msgid)
-            results.extend(result_data)
+            conn = self.conn
+            try:
+                msgid = conn.search_ext(base, scope, filterstr=filterstr, attrlist=attrlist, attrsonly=attrsonly,
+                                        serverctrls=(serverctrls or []) + [request_ctrl],
+                                        clientctrls=clientctrls, timeout=timeout, sizelimit=sizelimit)
+                start = time.monotonic()
+                result_type, result_data, result_msgid, result_ctrls = conn.result3(msgid)
+                elapsed = time.monotonic() - start
+                self._server.record_latency(elapsed)
+            except self.RETRY_ERRORS as e:
+                # Discard the connection even when not retrying, so it is
+                # not returned to the pool for a later search
+                uri = self._server.uri
+                self._unbind(failed=True)
+                if not retries:
+                    raise
+                retries -= 1
+                logger.warning("Search failed on %s, retrying: %s" % (uri, e))
+                # Paged results cookies are only valid on the server that
+                # issued them, so the search restarts on the next server
+                request_ctrl.cookie = ''
+                continue
+
+            yield self._record_page(result_data, elapsed, returned_dns, packer)
 
             # Extract the simple paged results response control
             paged_ctrls = [c for c in result_ctrls if c.controlType == SimplePagedResultsControl.controlType]
@@ -71,4 +252,29 @@ class LDAPSearch(object):
             else:
                 break
 
-        return results
+    def _record_page(self, result_data, elapsed, returned_dns=None, packer=None):
+        """
+        Return a page of results without the entries in ``returned_dns``,
+        adding the rest to it, and record the page in the statistics. The
+        entries are packed with ``packer`` if given, so the raw attributes
+        are released as soon as the page is received.
+        """
+        if returned_dns is not None:
+            page = []
+            for entry in result_data:
+                if isinstance(entry[1], Mapping):
+                    if entry[0].lower() in returned_dns:
+                        continue
+                    returned_dns.add(entry[0].lower())
+                page.append(entry)
+            result_data = page
+
+        if self.stats is not None:
+            self.stats.increment('pages')
+            self.stats.increment('entries', len(result_data))
+            self.stats.increment('bytes', sum(entry_size(entry) for entry in result_data))
+            self.stats.add_time('search', elapsed)
+
+        if packer is not None:
+            result_data = packer.pack_page(result_data)
+        return result_data
@@ -1,6 +1,11 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import FieldDoesNotExist
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from ldap_sync.converters import AttributeMap
 
 
 class LDAPSettings(object):
@@ -13,6 +18,7 @@ class LDAPSettings(object):
         'USER_ATTRIBUTES': {},
         'USER_EXTRA_ATTRIBUTES': [],
         'GROUPNAME_FIELD': 'name',
+        'GROUP_MEMBERSHIP_ATTRIBUTE': None,
         'USERNAME_FIELD': getattr(model, 'USERNAME_FIELD', 'username'),
         'USER_CALLBACKS': [],
         'REMOVED_USER_CALLBACKS': [],
@@ -21,23 +27,89 @@ class LDAPSettings(object):
         'BASE_PASS': '',
         'BASE': '',
         'PAGE_SIZE': 100,
+        'BATCH_SIZE': 500,
+        'PREFETCH_PAGES': 0,
+        'INCREMENTAL_ATTRIBUTE': None,
+        'FULL_SYNC_INTERVAL': 86400,
+        'DELTA_SYNC': None,
+        'FINGERPRINT_STORE': None,
+        'SEARCH_SHARDS': [],
+        'SHARD_ATTRIBUTE': None,
+        'SHARD_PREFIXES': 'abcdefghijklmnopqrstuvwxyz0123456789',
+        'SEARCH_THREADS': 4,
+        'POOL_SIZE': 4,
+        'SEARCH_RETRIES': 0,
+        'SERVER_RETRY_DELAY': 60,
+        'TASK_CHUNK_SIZE': 5000,
+        'CHECKPOINT_MAX_AGE': 86400,
+        'LOCK_TIMEOUT': 3600,
+        'SOURCES': [],
+        'SERVER_SORT': False,
+        'USER_CACHE_TIMEOUT': 300,
     }
 
     def __init__(self, prefix='LDAP_SYNC_'):
         """Load settings from Django configuration."""
+        self.prefix = prefix
         for name, default in self.defaults.items():
             value = getattr(settings, prefix + name, default)
             setattr(self, name, value)
 
+        # Compile the attribute mappings and their converters once
+        self.user_attribute_map = AttributeMap(self.USER_ATTRIBUTES)
+        self.group_attribute_map = AttributeMap(self.GROUP_ATTRIBUTES)
+
         self.validate()
 
+        # Resolve callbacks once rather than for every synchronized user
+        self.user_callbacks = [import_string(path) for path in self.USER_CALLBACKS]
+        self.removed_user_callbacks = [import_string(path) for path in self.REMOVED_USER_CALLBACKS]
+
+        # Several replicas may be given as a list or a space separated string
+        self.uris = self.URI.split() if isinstance(self.URI, str) else list(self.URI)
+
+        self.username_attribute = self.user_attribute_map.ldap_name(self.USERNAME_FIELD)
+
+        self.fingerprint_store = None
+        if self.FINGERPRINT_STORE:
+            self.fingerprint_store = import_string(self.FINGERPRINT_STORE)(self, prefix)
+
+    def _has_groups_relation(self):
+        try:
+            field = self.model._meta.get_field('groups')
+        except FieldDoesNotExist:
+            return False
+        return field.many_to_many and field.related_model is Group
+
     def validate(self):
         """Apply validation rules for loaded settings."""
-        if self.GROUP_ATTRIBUTES and self.GROUPNAME_FIELD not in self.GROUP_ATTRIBUTES.values():
+        if self.GROUP_ATTRIBUTES and self.GROUPNAME_FIELD not in self.group_attribute_map.fields:
             raise ImproperlyConfigured("LDAP_SYNC_GROUP_ATTRIBUTES must contain '%s'" % self.GROUPNAME_FIELD)
 
+        if self.GROUP_MEMBERSHIP_ATTRIBUTE not in (None, 'member', 'memberOf'):
+            raise ImproperlyConfigured("LDAP_SYNC_GROUP_MEMBERSHIP_ATTRIBUTE must be 'member' or 'memberOf'")
+
+        if self.GROUP_MEMBERSHIP_ATTRIBUTE and not self.GROUP_FILTER:
+            raise ImproperlyConfigured("LDAP_SYNC_GROUP_MEMBERSHIP_ATTRIBUTE requires LDAP_SYNC_GROUP_FILTER")
+
+        if self.GROUP_MEMBERSHIP_ATTRIBUTE and not self._has_groups_relation():
+            raise ImproperlyConfigured("LDAP_SYNC_GROUP_MEMBERSHIP_ATTRIBUTE requires a groups relation to Group "
+                                       "on the user model")
+
         if not self.model._meta.get_field(self.USERNAME_FIELD).unique:
             raise ImproperlyConfigured("LDAP_SYNC_USERNAME_FIELD '%s' must be unique" % self.USERNAME_FIELD)
 
-        if self.USER_ATTRIBUTES and self.USERNAME_FIELD not in self.USER_ATTRIBUTES.values():
+        if self.USER_ATTRIBUTES and self.USERNAME_FIELD not in self.user_attribute_map.fields:
             raise ImproperlyConfigured("LDAP_SYNC_USER_ATTRIBUTES must contain '%s'" % self.USERNAME_FIELD)
+
+        if self.DELTA_SYNC not in (None, 'dirsync', 'syncrepl'):
+            raise ImproperlyConfigured("LDAP_SYNC_DELTA_SYNC must be 'dirsync' or 'syncrepl'")
+
+        if self.SERVER_SORT and (self.SEARCH_SHARDS or self.SHARD_ATTRIBUTE):
+            raise ImproperlyConfigured("LDAP_SYNC_SERVER_SORT cannot be combined with sharded searches")
+
+        if self.prefix in self.SOURCES:
+            raise ImproperlyConfigured("LDAP_SYNC_SOURCES cannot contain its own prefix")
+
+        if self.DELTA_SYNC and self.INCREMENTAL_ATTRIBUTE:
+            raise ImproperlyConfigured("LDAP_SYNC_DELTA_SYNC and LDAP_SYNC_INCREMENTAL_ATTRIBUTE cannot both be set")
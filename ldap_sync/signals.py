@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+
+# Sent when SyncLDAP.sync() completes, with the SyncStats for the run as stats
+sync_finished = Signal()
@@ -0,0 +1,128 @@
+import base64
+import gzip
+import json
+from collections.abc import Mapping
+
+
+VERSION = 1
+
+
+def open_snapshot(path, mode):
+    """Open a snapshot file for text I/O, compressed if the path ends in .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def encode_value(value):
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(value).decode('ascii')}
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    return value.encode('utf-8')
+
+
+def encode_entry(cname, ldap_attributes):
+    """Return a JSON serializable [dn, attributes] list for a search result entry."""
+    return [cname, {name: [encode_value(value) for value in values] for name, values in ldap_attributes.items()}]
+
+
+def decode_entry(record, attrlist=None):
+    """Return the (dn, attributes) search result entry for an encoded entry."""
+    cname, attributes = record
+    return cname, {name: [decode_value(value) for value in values]
+                   for name, values in attributes.items() if attrlist is None or name in attrlist}
+
+
+class SnapshotWriter(object):
+    """
+    Write search results to a snapshot in JSON Lines format. The first line
+    identifies the format; each search then starts with a header object
+    holding its filter and attributes, followed by one [dn, attributes]
+    array for each entry. Values that are not valid UTF-8, such as GUIDs,
+    are stored base64 encoded.
+    """
+    def __init__(self, path):
+        self.file = open_snapshot(path, 'w')
+        self._write({'ldap_sync_snapshot': VERSION})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def write_search(self, filterstr, attrlist, entries):
+        """Write the entries returned by a search, returning the number written."""
+        self._write({'filter': filterstr, 'attributes': list(attrlist)})
+        count = 0
+        for cname, ldap_attributes in entries:
+            if not isinstance(ldap_attributes, Mapping):
+                continue
+            self._write(encode_entry(cname, ldap_attributes))
+            count += 1
+        return count
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')))
+        self.file.write('\n')
+
+
+class SnapshotSearch(object):
+    """
+    Answer searches from a recorded snapshot instead of a live server.
+    Searches are matched by filter, and entries are streamed from the file
+    as they are read.
+    """
+    live = False
+
+    def __init__(self, settings, path, stats=None):
+        self.settings = settings
+        self.path = path
+        self.stats = stats
+
+        with open_snapshot(path, 'r') as f:
+            header = json.loads(f.readline() or '{}')
+        if header.get('ldap_sync_snapshot') != VERSION:
+            raise ValueError("%s is not a supported LDAP snapshot" % path)
+
+    def iter_search(self, filterstr, attrlist, sharded=False, base=None):
+        """
+        Yield the recorded entries for a search. A search that was not
+        recorded, or that requests attributes that were not recorded,
+        raises ValueError rather than returning incomplete entries.
+        """
+        found = False
+        wanted = set(attrlist)
+        with open_snapshot(self.path, 'r') as f:
+            f.readline()
+            for line in f:
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    if found:
+                        break
+                    if record['filter'] == filterstr:
+                        found = True
+                        missing = wanted - set(record['attributes'])
+                        if missing:
+                            raise ValueError("Snapshot %s does not include attributes %s for filter %s" % (
+                                self.path, ', '.join(sorted(missing)), filterstr))
+                elif found:
+                    if self.stats is not None:
+                        self.stats.increment('entries')
+                    yield decode_entry(record, wanted)
+
+        if not found:
+            raise ValueError("Snapshot %s has no results for filter %s" % (self.path, filterstr))
+
+    def ranged_values(self, dn, ldap_attributes, attribute):
+        """Ranged attributes are resolved when a snapshot is recorded."""
+        return list(ldap_attributes.get(attribute, []))
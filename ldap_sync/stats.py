@@ -0,0 +1,71 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SyncStats(object):
+    """
+    Counts and per-phase timings collected during a synchronization. Counts
+    and timings may be recorded from several threads, such as when search
+    pages are prefetched or shards are searched concurrently.
+    """
+    counters = (
+        'groups_created', 'groups_unchanged', 'groups_errored',
+        'users_created', 'users_updated', 'users_unchanged', 'users_errored', 'users_removed',
+        'pages', 'entries', 'bytes', 'queries',
+    )
+    phases = ('search', 'decode', 'db', 'callbacks', 'removal')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.counters, 0)
+        self.timings = dict.fromkeys(self.phases, 0.0)
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['counts'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __str__(self):
+        lines = ['%s: %d' % (name.replace('_', ' ').capitalize(), self.counts[name]) for name in self.counters]
+        lines.extend('%s time: %.3fs' % (phase.capitalize(), self.timings[phase]) for phase in self.phases)
+        lines.append('Total time: %.3fs' % self.duration)
+        return '\n'.join(lines)
+
+    @property
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase):
+        """Add the time spent in the block to a phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.monotonic() - start)
+
+    def count_query(self, execute, sql, params, many, context):
+        """A database execute wrapper counting the queries issued."""
+        self.increment('queries')
+        return execute(sql, params, many, context)
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def as_dict(self):
+        stats = dict(self.counts)
+        stats.update(('%s_time' % phase, round(seconds, 3)) for phase, seconds in self.timings.items())
+        stats['duration'] = round(self.duration, 3)
+        return stats
@@ -1,12 +1,40 @@
 import logging
+import uuid
+from collections.abc import Mapping
+from contextlib import ExitStack
+from datetime import timedelta
 
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.db import DataError
 from django.db import IntegrityError
-from django.utils.module_loading import import_string
+from django.db import connections
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
+from ldap.filter import escape_filter_chars
+
+from ldap_sync.incremental import HighWaterMark
+from ldap_sync.membership import GroupMemberships
+from ldap_sync.models import EntryIdentifier
+from ldap_sync.models import SyncState
+from ldap_sync.plan import SyncPlan
+from ldap_sync.reconcile import MergeJoin
+from ldap_sync.runs import Checkpoint
+from ldap_sync.runs import RunLock
+from ldap_sync.runs import SyncLocked
 from ldap_sync.search import LDAPSearch
 from ldap_sync.settings import LDAPSettings
+from ldap_sync.snapshot import SnapshotSearch
+from ldap_sync.snapshot import SnapshotWriter
+from ldap_sync.signals import sync_finished
+from ldap_sync.stats import SyncStats
+from ldap_sync.utils import chunked
+from ldap_sync.utils import filter_key
+from ldap_sync.utils import interleave
 
 
 logger = logging.getLogger(__name__)
@@ -14,14 +42,23 @@ logger = logging.getLogger(__name__)
 
 class SyncLDAP(object):
     _ldap = None
+    _memberships = None
     _settings = None
+    _lock = None
+    _stats = None
 
     settings_prefix = 'LDAP_SYNC_'
 
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+
     @property
     def ldap(self):
         if self._ldap is None:
-            self._ldap = LDAPSearch(self.settings)
+            if self.snapshot:
+                self._ldap = SnapshotSearch(self.settings, self.snapshot, stats=self.stats)
+            else:
+                self._ldap = LDAPSearch(self.settings, stats=self.stats)
         return self._ldap
 
     @property
@@ -30,39 +67,411 @@ class SyncLDAP(object):
             self._settings = LDAPSettings(prefix=self.settings_prefix)
         return self._settings
 
-    def sync(self):
-        """Wrapper method to sync both groups and users."""
-        self.sync_groups()
-        self.sync_users()
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = SyncStats()
+        return self._stats
+
+    def sync(self, full=False):
+        """
+        Wrapper method to sync groups, users and group memberships. Returns
+        the SyncStats for the run, which are also sent with the sync_finished
+        signal.
+        """
+        if self.snapshot and self.settings.SOURCES:
+            # A snapshot only records the searches of this configuration
+            raise ImproperlyConfigured("Synchronizing from a snapshot does not support LDAP_SYNC_SOURCES")
+
+        lock = self.run_lock()
+        if not lock.acquire():
+            raise SyncLocked("A synchronization is already running for %s" % self.settings_prefix)
+
+        self._stats = stats = SyncStats()
+        if self._ldap is not None:
+            self._ldap.stats = stats
+
+        self._lock = lock
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.count_query))
+                if self.settings.SOURCES:
+                    self._sync_sources()
+                else:
+                    self.sync_groups()
+                    self.sync_users(full=full)
+                    self.sync_memberships()
+        finally:
+            self._lock = None
+            lock.release()
+
+        stats.finish()
+        sync_finished.send(sender=self.__class__, stats=stats)
+        return stats
+
+    def run_lock(self, owner=None):
+        """
+        Return the lock preventing concurrent synchronizations for this
+        settings prefix, or the lock held by ``owner`` if given.
+        """
+        return RunLock(self.settings_prefix, self.settings.LOCK_TIMEOUT, owner=owner)
+
+    def plan(self):
+        """
+        Return a SyncPlan of the groups and users a full synchronization
+        would create, update and remove, without writing any changes.
+        """
+        plan = SyncPlan(self.settings)
+        plan.load()
+        if self.settings.GROUP_FILTER:
+            group_attributes = list(self.settings.GROUP_ATTRIBUTES.keys())
+            plan.diff_groups(self.ldap.iter_search(self.settings.GROUP_FILTER, group_attributes))
+        if self.settings.USER_FILTER:
+            user_attributes = list(self.settings.USER_ATTRIBUTES.keys())
+            plan.diff_users(self.ldap.iter_search(self.settings.USER_FILTER, user_attributes, sharded=True))
+        return plan
+
+    def record(self, path):
+        """
+        Write the group and user search results to a snapshot file, which
+        can be synchronized later with SyncLDAP(snapshot=path) without
+        querying LDAP. Ranged attributes are resolved before writing.
+        """
+        with SnapshotWriter(path) as writer:
+            if self.settings.GROUP_FILTER:
+                ldap_groups = self.ldap.iter_search(self.settings.GROUP_FILTER, self._group_attributes())
+                if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'member':
+                    ldap_groups = self._resolve_ranges(ldap_groups, 'member')
+                count = writer.write_search(self.settings.GROUP_FILTER, self._group_attributes(), ldap_groups)
+                logger.info("Recorded %d groups to %s" % (count, path))
+            if self.settings.USER_FILTER:
+                ldap_users = self.ldap.iter_search(self.settings.USER_FILTER, self._user_attributes(), sharded=True)
+                if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'memberOf':
+                    ldap_users = self._resolve_ranges(ldap_users, 'memberOf')
+                count = writer.write_search(self.settings.USER_FILTER, self._user_attributes(), ldap_users)
+                logger.info("Recorded %d users to %s" % (count, path))
+
+    @property
+    def group_dns(self):
+        """The group DN to group name mapping collected by sync_groups()."""
+        if self._memberships is None:
+            return None
+        return dict(self._memberships.group_dns)
+
+    def user_shards(self):
+        """Return the (base, filterstr) shards of the user search, if sharding is configured."""
+        if not (self.settings.SEARCH_SHARDS or self.settings.SHARD_ATTRIBUTE):
+            return []
+        return self.ldap.shards(self.settings.USER_FILTER)
+
+    def iter_users(self, base=None, filterstr=None):
+        """Yield the entries of a full user search, or of a single shard of it."""
+        if base is None and filterstr is None:
+            return self.ldap.iter_search(self.settings.USER_FILTER, self._user_attributes(), sharded=True)
+        return self.ldap.iter_search(filterstr or self.settings.USER_FILTER, self._user_attributes(), base=base)
+
+    def sync_user_entries(self, ldap_users, group_dns=None, lock_owner=None):
+        """
+        Synchronize part of the user search as one task of a distributed
+        synchronization, returning the usernames seen. Memberships from
+        memberOf attributes are applied for these users if the group DNs
+        collected by sync_groups() are given. Removed users are reconciled
+        separately by remove_missing_users() once every part is complete.
+        The run's lock is refreshed as batches complete if its
+        ``lock_owner`` is given.
+        """
+        if lock_owner is not None:
+            self._lock = self.run_lock(lock_owner)
+        if group_dns is not None and self.settings.GROUP_MEMBERSHIP_ATTRIBUTE:
+            self._memberships = GroupMemberships(self.settings, self.ldap)
+            self._memberships.group_dns = group_dns
+        usernames = self._sync_ldap_users(ldap_users, remove=False)
+        self.sync_memberships()
+        return usernames
+
+    def remove_missing_users(self, usernames, lock_owner=None):
+        """
+        Call the removed user callbacks for every user not in ``usernames``.
+        The run's lock is refreshed as users are removed if its
+        ``lock_owner`` is given.
+        """
+        if lock_owner is not None:
+            self._lock = self.run_lock(lock_owner)
+        if self.settings.REMOVED_USER_CALLBACKS:
+            field = self.settings.USERNAME_FIELD
+            users = self.settings.model.objects.values_list(field, 'pk').iterator()
+            self._remove_users([pk for username, pk in users if username.lower() not in usernames])
+
+    def _resolve_ranges(self, entries, attribute):
+        prefix = attribute.lower() + ';range='
+        for cname, ldap_attributes in entries:
+            if isinstance(ldap_attributes, Mapping):
+                values = self.ldap.ranged_values(cname, ldap_attributes, attribute)
+                ldap_attributes = {name: value for name, value in ldap_attributes.items()
+                                   if not name.lower().startswith(prefix)}
+                ldap_attributes[attribute] = values
+            yield cname, ldap_attributes
+
+    def _group_attributes(self):
+        group_attributes = list(self.settings.GROUP_ATTRIBUTES.keys())
+        if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'member':
+            group_attributes.append('member')
+        return group_attributes
+
+    def _user_attributes(self):
+        user_attributes = list(self.settings.USER_ATTRIBUTES.keys()) + self.settings.USER_EXTRA_ATTRIBUTES
+        for callback in self.settings.user_callbacks:
+            for name in getattr(callback, 'attributes', ()):
+                if name not in user_attributes:
+                    user_attributes.append(name)
+        if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE == 'memberOf':
+            user_attributes.append('memberOf')
+        return user_attributes
 
     def sync_groups(self):
         """Synchronize LDAP groups with local group model."""
         if self.settings.GROUP_FILTER:
-            ldap_groups = self.ldap.search(self.settings.GROUP_FILTER, self.settings.GROUP_ATTRIBUTES.keys())
+            if self.settings.GROUP_MEMBERSHIP_ATTRIBUTE:
+                self._memberships = GroupMemberships(self.settings, self.ldap)
+            ldap_groups = self.ldap.iter_search(self.settings.GROUP_FILTER, self._group_attributes())
             self._sync_ldap_groups(ldap_groups)
             logger.info("Groups are synchronized")
 
-    def sync_users(self):
-        """Synchronize LDAP users with local user model."""
+    def _sync_sources(self):
+        """
+        Synchronize the directories configured with the settings prefixes in
+        SOURCES. Groups are synchronized from each source in turn, then the
+        user searches of every source run concurrently. A username found in
+        more than one source is synchronized from the source listed first,
+        and removed users are reconciled once across all of the sources using
+        this configuration's removed user callbacks.
+        """
+        sources = []
+        for prefix in self.settings.SOURCES:
+            source = self.__class__()
+            source.settings_prefix = prefix
+            source._stats = self.stats
+            source._lock = self._lock
+            sources.append(source)
+
+        for source in sources:
+            source.sync_groups()
+            if source._memberships is not None:
+                source._memberships.users_complete = True
+
+        def pages(index, source):
+            user_attributes = source._user_attributes()
+            for page in source.ldap.search_pages(source.settings.USER_FILTER, user_attributes, sharded=True):
+                yield index, page
+
+        user_index = self._load_user_index()
+        ldap_usernames = set()
+        owners = {}
+        batches = [[] for source in sources]
+
+        def flush(index):
+            # Drop buffered entries claimed by a higher precedence source since
+            # they were buffered, as that source synchronizes them instead
+            batch = [(cname, ldap_attributes) for cname, ldap_attributes in batches[index]
+                     if owners[sources[index]._entry_username(ldap_attributes)] == index]
+            with transaction.atomic():
+                ldap_usernames.update(sources[index]._sync_ldap_user_batch(batch, user_index))
+            batches[index] = []
+            if self._lock is not None:
+                self._lock.refresh()
+
+        searches = [pages(index, source) for index, source in enumerate(sources)]
+        for index, page in interleave(searches, len(sources) * 2):
+            for cname, ldap_attributes in page:
+                username = sources[index]._entry_username(ldap_attributes)
+                if username is None:
+                    continue
+                # An entry is skipped if a higher precedence source has
+                # already returned the username, and is overwritten if one
+                # returns it later
+                if owners.get(username, index) < index:
+                    continue
+                owners[username] = index
+                batches[index].append((cname, ldap_attributes))
+            if len(batches[index]) >= self.settings.BATCH_SIZE:
+                flush(index)
+
+        for index, batch in enumerate(batches):
+            if batch:
+                flush(index)
+        logger.info("Users are synchronized from %d sources" % len(sources))
+
+        for source in sources:
+            source.sync_memberships()
+
+        if self.settings.REMOVED_USER_CALLBACKS:
+            self._remove_users([user.pk for username, user in user_index.items() if username not in ldap_usernames])
+
+    def sync_user(self, username):
+        """
+        Synchronize a single user, returning the local user, or None if the
+        username is not found by the user search. Users found and not found
+        are cached for USER_CACHE_TIMEOUT seconds, so repeated lookups do not
+        query LDAP. Group memberships are not synchronized.
+        """
+        if not self.settings.USER_FILTER:
+            return None
+
+        username = username.lower()
+        key = 'ldap_sync:%s:%s' % (self.settings_prefix, filter_key('user', username))
+        timeout = self.settings.USER_CACHE_TIMEOUT
+        if timeout:
+            cached = cache.get(key)
+            if cached is False:
+                return None
+            if cached is not None:
+                user = self.settings.model.objects.filter(pk=cached).first()
+                if user is not None:
+                    return user
+
+        user_filter = self.settings.USER_FILTER
+        if not user_filter.startswith('('):
+            user_filter = '(%s)' % user_filter
+        user_filter = '(&%s(%s=%s))' % (user_filter, self.settings.username_attribute, escape_filter_chars(username))
+        ldap_users = [(cname, ldap_attributes) for cname, ldap_attributes
+                      in self.ldap.iter_search(user_filter, self._user_attributes())
+                      if isinstance(ldap_attributes, Mapping)]
+
+        user = None
+        if username in self._sync_ldap_users(ldap_users, remove=False):
+            names = [value.decode('utf-8') for cname, ldap_attributes in ldap_users
+                     for value in ldap_attributes.get(self.settings.username_attribute, ())[:1]]
+            user = self._get_existing_users([username], names).get(username)
+        # Users that could not be written are looked up again next time
+        if timeout and (user is not None or not ldap_users):
+            cache.set(key, user.pk if user is not None else False, timeout)
+        return user
+
+    def sync_users(self, full=False):
+        """
+        Synchronize LDAP users with local user model. If incremental or delta
+        synchronization is configured, only entries changed since the previous
+        run are retrieved unless a full synchronization is requested or due.
+        Synchronizing from a snapshot is always a full synchronization.
+        """
         if self.settings.USER_FILTER:
-            user_attributes = self.settings.USER_ATTRIBUTES.keys() + self.settings.USER_EXTRA_ATTRIBUTES
-            ldap_users = self.ldap.search(self.settings.USER_FILTER, user_attributes)
-            self._sync_ldap_users(ldap_users)
+            user_attributes = self._user_attributes()
+            if self.settings.DELTA_SYNC and self.ldap.live:
+                self._sync_delta_users(user_attributes, full)
+            else:
+                self._search_users(user_attributes, full)
             logger.info("Users are synchronized")
 
+    def sync_memberships(self):
+        """
+        Synchronize group memberships collected by the preceding calls to
+        sync_groups() and sync_users().
+        """
+        if self._memberships is not None:
+            self._memberships.lock = self._lock
+            with self.stats.timer('db'):
+                self._memberships.apply()
+            self._memberships = None
+            logger.info("Group memberships are synchronized")
+
+    def _search_users(self, user_attributes, full):
+        user_filter = self.settings.USER_FILTER
+        watermark = None
+
+        if self.settings.INCREMENTAL_ATTRIBUTE and self.ldap.live:
+            user_attributes.append(self.settings.INCREMENTAL_ATTRIBUTE)
+            state_key = HighWaterMark.key(self.settings.USER_FILTER, self.settings.INCREMENTAL_ATTRIBUTE)
+            state = SyncState.objects.get_value(self.settings_prefix, state_key, {})
+            full = full or self._full_sync_due(state, 'watermark')
+            watermark = HighWaterMark(self.settings.INCREMENTAL_ATTRIBUTE, state.get('watermark'))
+            if not full:
+                user_filter = watermark.filter(user_filter)
+                logger.info("Synchronizing users changed since %s" % watermark.value)
+
+        # Removed users can only be detected by a full synchronization
+        remove = watermark is None or full
+        ordered = remove and self.settings.SERVER_SORT and self.ldap.live
+
+        if ordered:
+            ldap_users = self.ldap.iter_search(user_filter, user_attributes, sort=self.settings.username_attribute)
+        else:
+            ldap_users = self.ldap.iter_search(user_filter, user_attributes, sharded=True)
+        if watermark is not None:
+            ldap_users = watermark.track(ldap_users)
+
+        self._sync_ldap_users(ldap_users, remove=remove, ordered=ordered)
+
+        if watermark is not None and watermark.value is not None:
+            if full:
+                state['full_sync'] = timezone.now().isoformat()
+            state['watermark'] = watermark.value
+            SyncState.objects.set_value(self.settings_prefix, state_key, state)
+
+    def _sync_delta_users(self, user_attributes, full):
+        """
+        Synchronize users changed since the previous run using a server-side
+        change tracking control. Delete notifications are resolved to local
+        usernames through the stored entry identifiers and passed to the
+        removed user callbacks without a full scan.
+        """
+        state_key = filter_key('users:delta', self.settings.USER_FILTER, self.settings.DELTA_SYNC)
+        state = SyncState.objects.get_value(self.settings_prefix, state_key, {})
+        full = full or self._full_sync_due(state, 'cookie')
+        delta = self.ldap.delta_search(None if full else state['cookie'])
+        deleted = []
+
+        def changed_users():
+            for identifier, entry in delta.changes(self.settings.USER_FILTER, user_attributes):
+                if entry is None:
+                    deleted.append(identifier)
+                else:
+                    yield entry
+
+        self._sync_ldap_users(changed_users(), remove=full, delta=delta)
+
+        identifiers = EntryIdentifier.objects.filter(prefix=self.settings_prefix)
+        if delta.present is not None:
+            # The server sent the identifiers of unchanged entries rather
+            # than explicit deletes, so anything not present was removed
+            deleted.extend(set(identifiers.values_list('identifier', flat=True)) - delta.present)
+
+        for chunk in chunked(deleted, self.settings.BATCH_SIZE):
+            removed = identifiers.filter(identifier__in=chunk)
+            if not full and self.settings.REMOVED_USER_CALLBACKS:
+                usernames = removed.values_list('username', flat=True)
+                self._remove_users([user.pk for user in self._get_existing_users(usernames).values()])
+            removed.delete()
+
+        if full:
+            state['full_sync'] = timezone.now().isoformat()
+        state['cookie'] = delta.cookie
+        SyncState.objects.set_value(self.settings_prefix, state_key, state)
+
+    def _full_sync_due(self, state, key):
+        if key not in state or 'full_sync' not in state:
+            return True
+        if self.settings.FULL_SYNC_INTERVAL is None:
+            return False
+        last_full_sync = parse_datetime(state['full_sync'])
+        return timezone.now() - last_full_sync >= timedelta(seconds=self.settings.FULL_SYNC_INTERVAL)
+
     def _sync_ldap_groups(self, ldap_groups):
-        for cname, ldap_attributes in ldap_groups:
-            defaults = {}
+        # Commit once for each batch of groups rather than for every group
+        for batch in chunked(ldap_groups, self.settings.BATCH_SIZE):
+            with transaction.atomic():
+                self._sync_ldap_group_batch(batch)
+            if self._lock is not None:
+                self._lock.refresh()
 
-            if not isinstance(ldap_attributes, dict):
+    def _sync_ldap_group_batch(self, ldap_groups):
+        for cname, ldap_attributes in ldap_groups:
+            if not isinstance(ldap_attributes, Mapping):
                 # In some cases attrs is not a dict; skip these invalid groups
                 continue
 
-            for ldap_name, field in self.settings.GROUP_ATTRIBUTES.items():
-                try:
-                    defaults[field] = self.settings.GROUP_ATTRIBUTES[ldap_name][0].decode('utf-8')
-                except KeyError:
-                    defaults[field] = ''
+            with self.stats.timer('decode'):
+                defaults = self.settings.group_attribute_map(ldap_attributes)
 
             groupname = defaults[self.settings.GROUPNAME_FIELD]
             kwargs = {
@@ -70,46 +479,220 @@ class SyncLDAP(object):
                 'defaults': defaults,
             }
 
+            if self._memberships is not None:
+                self._memberships.add_group(cname, groupname, ldap_attributes)
+
             try:
-                group, created = Group.objects.get_or_create(**kwargs)
+                # A savepoint isolates a failing group from the rest of the batch
+                with self.stats.timer('db'), transaction.atomic():
+                    group, created = Group.objects.get_or_create(**kwargs)
             except (IntegrityError, DataError) as e:
                 logger.error("Error creating group %s: %s" % (groupname, e))
+                self.stats.increment('groups_errored')
             else:
                 if created:
                     logger.debug("Created group %s" % groupname)
+                    self.stats.increment('groups_created')
+                else:
+                    self.stats.increment('groups_unchanged')
 
-    def _sync_ldap_users(self, ldap_users):
+    def _sync_ldap_users(self, ldap_users, remove=True, delta=None, ordered=False):
+        """
+        Synchronize LDAP users, returning the usernames seen. If ``ordered``,
+        the entries are sorted by username and each batch's existing users
+        and the removed users are found by a merge join with the local
+        users, in which case the usernames seen are not collected.
+        """
         ldap_usernames = set()
 
-        for cname, ldap_attributes in ldap_users:
-            defaults = {}
+        # A full synchronization visits nearly every user, so load them all
+        # once; ordered synchronizations read them in order alongside the
+        # search, and partial synchronizations only look up the users they see
+        user_index = self._load_user_index() if remove and not ordered else None
+        if self._memberships is not None:
+            self._memberships.users_complete = remove
+
+        checkpoint = None
+        if remove and self.settings.CHECKPOINT_MAX_AGE:
+            run = self._lock.owner if self._lock is not None else uuid.uuid4().hex
+            key = filter_key('users:checkpoint', self.settings.USER_FILTER)
+            checkpoint = Checkpoint(self.settings_prefix, key, run)
+            ldap_usernames = checkpoint.load(self.settings.CHECKPOINT_MAX_AGE)
+            if ldap_usernames:
+                ldap_users = self._skip_users(ldap_users, ldap_usernames)
+                if self._memberships is not None:
+                    # Skipped users were not collected, so leave their memberships alone
+                    self._memberships.users_complete = False
+
+        merge = MergeJoin(self.settings, keep=ldap_usernames) if ordered else None
+
+        # Each batch is read from LDAP before its transaction begins and is
+        # committed once; rows that fail are rolled back to a savepoint
+        for batch in chunked(ldap_users, self.settings.BATCH_SIZE):
+            existing_users = user_index
+            if merge is not None:
+                # Existing users are looked up instead if the merge join
+                # finds either side out of order
+                usernames = [self._entry_username(ldap_attributes) for cname, ldap_attributes in batch]
+                existing_users = merge.advance([username for username in usernames if username is not None])
+            with transaction.atomic():
+                batch_usernames = self._sync_ldap_user_batch(batch, existing_users)
+                if delta is not None:
+                    with self.stats.timer('db'):
+                        self._store_entry_identifiers(batch, delta)
+                if checkpoint is not None:
+                    checkpoint.save(batch_usernames)
+            if not ordered:
+                ldap_usernames.update(batch_usernames)
+            if self._lock is not None:
+                self._lock.refresh()
 
-            if not isinstance(ldap_attributes, dict):
-                # In some cases attributes is not a dict; skip these invalid users
+        if merge is not None:
+            if remove and self.settings.REMOVED_USER_CALLBACKS:
+                removed = merge.finish()
+                if removed is not None:
+                    self._remove_users(removed)
+        elif remove and self.settings.REMOVED_USER_CALLBACKS:
+            self._remove_users([user.pk for username, user in user_index.items() if username not in ldap_usernames])
+
+        if checkpoint is not None:
+            checkpoint.clear()
+
+        return ldap_usernames
+
+    def _skip_users(self, ldap_users, usernames):
+        """Yield entries whose usernames are not in ``usernames``."""
+        for cname, ldap_attributes in ldap_users:
+            if self._entry_username(ldap_attributes) in usernames:
                 continue
+            yield cname, ldap_attributes
+
+    def _entry_username(self, ldap_attributes):
+        """Return the lowercased username of an entry, or None if it has none."""
+        if not isinstance(ldap_attributes, Mapping):
+            return None
+        try:
+            return ldap_attributes[self.settings.username_attribute][0].decode('utf-8').lower()
+        except KeyError:
+            return None
+
+    def _remove_users(self, pks):
+        """
+        Call the removed user callbacks for the given users in chunks. Bulk
+        callbacks receive a queryset for each chunk; other callbacks are
+        called once for each user.
+        """
+        for chunk in chunked(pks, self.settings.BATCH_SIZE):
+            if self._lock is not None:
+                self._lock.refresh()
+            users = self.settings.model.objects.filter(pk__in=chunk)
+            self.stats.increment('users_removed', len(chunk))
+            with self.stats.timer('removal'), transaction.atomic():
+                for callback in self.settings.removed_user_callbacks:
+                    if getattr(callback, 'bulk', False):
+                        callback(users)
+                        logger.debug("Called %s for %d users" % (callback.__name__, len(chunk)))
+                    else:
+                        for user in users:
+                            callback(user)
+                            username = getattr(user, self.settings.USERNAME_FIELD)
+                            logger.debug("Called %s for user %s" % (callback.__name__, username))
+
+    def _store_entry_identifiers(self, ldap_users, delta):
+        """Record the server assigned identifier of each entry in a batch."""
+        usernames = {}
+        for cname, ldap_attributes in ldap_users:
+            username = self._entry_username(ldap_attributes)
+            if username is not None:
+                usernames[delta.identifier(ldap_attributes)] = username
+
+        identifiers = EntryIdentifier.objects.filter(prefix=self.settings_prefix, identifier__in=list(usernames))
+        for entry in identifiers:
+            username = usernames.pop(entry.identifier)
+            if entry.username != username:
+                identifiers.filter(pk=entry.pk).update(username=username)
+
+        EntryIdentifier.objects.bulk_create([
+            EntryIdentifier(prefix=self.settings_prefix, identifier=identifier, username=username)
+            for identifier, username in usernames.items()
+        ])
+
+    def _sync_ldap_user_batch(self, ldap_users, user_index=None):
+        """
+        Synchronize a batch of LDAP users, returning the usernames seen. New
+        users are written with a single bulk insert and changed users with a
+        single bulk update; rows that fail are retried individually so one
+        bad entry does not discard the rest of the batch. Existing users are
+        matched against ``user_index`` if given, otherwise they are queried.
+        """
+        entries = {}
+        names = []
+        fingerprints = {}
+        fingerprint_store = self.settings.fingerprint_store
+        stats = self.stats
+
+        with stats.timer('decode'):
+            for cname, ldap_attributes in ldap_users:
+                if not isinstance(ldap_attributes, Mapping):
+                    # In some cases attributes is not a dict; skip these invalid users
+                    continue
 
-            for ldap_name, field in self.settings.USER_ATTRIBUTES.items():
                 try:
-                    defaults[field] = ldap_attributes[ldap_name][0].decode('utf-8')
+                    name = ldap_attributes[self.settings.username_attribute][0].decode('utf-8')
                 except KeyError:
-                    defaults[field] = ''
+                    name = ''
+                username = name.lower()
+                entries[username] = ldap_attributes
+                names.append(name)
 
-            username = defaults[self.settings.USERNAME_FIELD].lower()
-            kwargs = {
-                self.settings.USERNAME_FIELD + '__iexact': username,
-                'defaults': defaults,
-            }
+                if fingerprint_store is not None:
+                    fingerprints[username] = fingerprint_store.fingerprint(ldap_attributes)
 
-            try:
-                user, created = self.settings.model.objects.get_or_create(**kwargs)
-            except (IntegrityError, DataError) as e:
-                logger.error("Error creating user %s: %s" % (username, e))
+                if self._memberships is not None:
+                    self._memberships.add_user(cname, username, ldap_attributes)
+
+        with stats.timer('db'):
+            if user_index is None:
+                existing_users = self._get_existing_users(entries.keys(), names)
             else:
+                existing_users = user_index
+
+            unchanged_usernames = set()
+            if fingerprints:
+                stored = fingerprint_store.get_many(fingerprints.keys())
+                unchanged_usernames = set(username for username, fingerprint in fingerprints.items()
+                                          if username in existing_users and stored.get(username) == fingerprint)
+
+        created_users = []
+        updated_users = []
+        synced_users = []
+        current_values = {}
+
+        with stats.timer('decode'):
+            changed_entries = [(username, ldap_attributes) for username, ldap_attributes in entries.items()
+                               if username not in unchanged_usernames]
+            conversion_errors = {}
+            field_values = self.settings.user_attribute_map.map_many(
+                (ldap_attributes for username, ldap_attributes in changed_entries), errors=conversion_errors)
+
+            unconverted = set()
+            for position, ((username, ldap_attributes), defaults) in enumerate(zip(changed_entries, field_values)):
+                if position in conversion_errors:
+                    logger.error("Error converting attributes of user %s: %s" %
+                                 (username, conversion_errors[position]))
+                    unconverted.add(username)
+                    continue
+
+                user = existing_users.get(username)
+                created = user is None
                 updated = False
+
                 if created:
-                    logger.debug("Created user %s" % username)
+                    user = self.settings.model(**defaults)
                     user.set_unusable_password()
+                    created_users.append((username, user))
                 else:
+                    current_values[username] = self._get_field_values(user)
                     for name, attr in defaults.items():
                         current_attr = getattr(user, name, None)
                         if current_attr != attr:
@@ -118,25 +701,156 @@ class SyncLDAP(object):
                     if updated:
                         logger.debug("Updated user %s" % username)
 
-                for path in self.settings.USER_CALLBACKS:
-                    callback = import_string(path)
-                    callback(user, ldap_attributes, created, updated)
+                synced_users.append((username, (user, ldap_attributes, created, updated)))
 
-                # It's possible for an IntegrityError to occur here
-                # due to user modifications made by callbacks
+        # New users are inserted before callbacks run, so callbacks receive
+        # saved users and may change their relations; users that could not
+        # be inserted are not passed to callbacks
+        with stats.timer('db'):
+            failed_created = self._bulk_create_users(created_users)
+        synced_users = [(username, synced) for username, synced in synced_users if username not in failed_created]
+        for username, user in created_users:
+            if username not in failed_created:
+                current_values[username] = self._get_field_values(user)
+
+        callback_users = [synced for username, synced in synced_users]
+        with stats.timer('callbacks'):
+            for callback in self.settings.user_callbacks:
+                if getattr(callback, 'bulk', False):
+                    callback(callback_users)
+                else:
+                    for user, ldap_attributes, created, updated in callback_users:
+                        callback(user, ldap_attributes, created, updated)
+
+        for username, (user, ldap_attributes, created, updated) in synced_users:
+            # Callbacks may modify fields beyond the mapped attributes,
+            # so compare every field against its value before the callbacks
+            changed_fields = [name for name, value in self._get_field_values(user).items()
+                              if current_values[username][name] != value]
+            if changed_fields:
+                updated_users.append((username, user, changed_fields))
+
+        with stats.timer('db'):
+            failed_updated = self._bulk_update_users(updated_users)
+            failed_usernames = failed_created | failed_updated | unconverted
+
+            if fingerprints:
+                fingerprint_store.set_many({username: fingerprint for username, fingerprint in fingerprints.items()
+                                            if username not in unchanged_usernames and
+                                            username not in failed_usernames})
+
+        created_usernames = set(username for username, user in created_users)
+        updated_usernames = set(username for username, user, changed_fields in updated_users
+                                if username not in created_usernames)
+        # A new user whose callback changes failed to save is only counted
+        # as an error, so every entry is counted once
+        stats.increment('users_created', len(created_usernames - failed_created - failed_updated))
+        stats.increment('users_updated', len(updated_usernames - failed_updated))
+        stats.increment('users_unchanged',
+                        len(entries) - len(created_users) - len(updated_usernames) - len(unconverted))
+        stats.increment('users_errored', len(failed_usernames))
+
+        if user_index is not None:
+            for username, user in created_users:
+                if username not in failed_created:
+                    user_index[username] = user
+
+        # Users whose update failed are still in LDAP, so they are seen;
+        # new users that could not be converted or created are not
+        uncreated = failed_created | set(username for username in unconverted if username not in existing_users)
+        return set(entries.keys()) - uncreated
+
+    def _load_user_index(self):
+        """Return a mapping of lowercased username to user for all users."""
+        field = self.settings.USERNAME_FIELD
+        return {getattr(user, field).lower(): user for user in self.settings.model.objects.iterator()}
+
+    def _get_existing_users(self, usernames, names=()):
+        """
+        Return a mapping of lowercased username to user for existing users.
+        Users are first matched exactly on the lowercased usernames and on
+        ``names``, such as the usernames as LDAP returned them, which uses
+        the username index; only usernames still not found are compared
+        case-insensitively, which cannot.
+        """
+        field = self.settings.USERNAME_FIELD
+        usernames = set(usernames)
+        users = self.settings.model.objects.filter(**{field + '__in': list(usernames | set(names))})
+        existing = {getattr(user, field).lower(): user for user in users}
+
+        missing = [username for username in usernames if username not in existing]
+        if missing:
+            users = self.settings.model.objects.annotate(ldap_sync_username=Lower(field))
+            existing.update((user.ldap_sync_username, user)
+                            for user in users.filter(ldap_sync_username__in=missing))
+        return existing
+
+    def _get_field_values(self, user):
+        return {field.attname: getattr(user, field.attname) for field in self.settings.model._meta.concrete_fields
+                if not field.primary_key}
+
+    def _bulk_create_users(self, created_users):
+        """Insert new users, returning the usernames that could not be created."""
+        failed_usernames = set()
+        if not created_users:
+            return failed_usernames
+
+        try:
+            with transaction.atomic():
+                self.settings.model.objects.bulk_create([user for username, user in created_users],
+                                                        batch_size=self.settings.BATCH_SIZE)
+        except (IntegrityError, DataError):
+            for username, user in created_users:
                 try:
-                    user.save()
-                except IntegrityError as e:
-                    logger.error("Error updating user %s: %s" % (username, e))
+                    with transaction.atomic():
+                        user.save(force_insert=True)
+                except (IntegrityError, DataError) as e:
+                    logger.error("Error creating user %s: %s" % (username, e))
+                    failed_usernames.add(username)
+                else:
+                    logger.debug("Created user %s" % username)
+        else:
+            # Callbacks run on the inserted users, so fetch primary keys on
+            # backends where bulk_create() does not set them
+            missing = [username for username, user in created_users if user.pk is None]
+            if missing:
+                field = self.settings.USERNAME_FIELD
+                saved_users = self._get_existing_users(missing, [getattr(user, field) for username, user
+                                                                 in created_users if user.pk is None])
+                for username, user in created_users:
+                    if user.pk is None:
+                        user.pk = saved_users[username].pk
+                        user._state.adding = False
+            for username, user in created_users:
+                logger.debug("Created user %s" % username)
 
-                if self.settings.REMOVED_USER_CALLBACKS:
-                    ldap_usernames.add(username)
+        return failed_usernames
 
-        if self.settings.REMOVED_USER_CALLBACKS:
-            django_usernames = set(self.settings.model.objects.values_list(self.settings.USERNAME_FIELD, flat=True))
-            for username in django_usernames - ldap_usernames:
-                user = self.settings.model.objects.get(**{self.settings.USERNAME_FIELD: username})
-                for path in self.settings.REMOVED_USER_CALLBACKS:
-                    callback = import_string(path)
-                    callback(user)
-                    logger.debug("Called %s for user %s" % (path, username))
+    def _bulk_update_users(self, updated_users):
+        """
+        Write changed fields for existing users, returning the usernames
+        that could not be updated. Users are grouped by the set of fields
+        that changed so each update only writes fields that differ.
+        """
+        failed_usernames = set()
+        updates = {}
+        for username, user, changed_fields in updated_users:
+            updates.setdefault(tuple(sorted(changed_fields)), []).append((username, user))
+
+        for fields, users in updates.items():
+            try:
+                with transaction.atomic():
+                    self.settings.model.objects.bulk_update([user for username, user in users], fields,
+                                                            batch_size=self.settings.BATCH_SIZE)
+            except (IntegrityError, DataError):
+                # It's possible for an IntegrityError to occur here
+                # due to user modifications made by callbacks
+                for username, user in users:
+                    try:
+                        with transaction.atomic():
+                            user.save(update_fields=fields)
+                    except (IntegrityError, DataError) as e:
+                        logger.error("Error updating user %s: %s" % (username, e))
+                        failed_usernames.add(username)
+
+        return failed_usernames
@@ -1,10 +1,127 @@
+import logging
+from collections.abc import Mapping
+
+from celery import chord
 from celery import shared_task
 
+from ldap_sync.runs import SyncLocked
+from ldap_sync.snapshot import decode_entry
+from ldap_sync.snapshot import encode_entry
 from ldap_sync.sync import SyncLDAP
+from ldap_sync.utils import chunked
+
+
+logger = logging.getLogger(__name__)
+
+# How often the collecting task of a distributed synchronization checks
+# whether its chunk tasks are complete, in seconds
+COLLECT_INTERVAL = 10
+
+
+@shared_task
+def syncldap(full=False):
+    sync_ldap = SyncLDAP()
+    return sync_ldap.sync(full=full).as_dict()
 
 
 @shared_task
-def syncldap():
+def syncldap_distributed():
+    """
+    Synchronize groups, then fan the user synchronization out to the worker
+    pool. Each configured search shard is searched and synchronized by its
+    own task, and removed users are reconciled by a chord callback once
+    every task has reported the usernames it saw. Without shards, the user
+    search is read here and each chunk of TASK_CHUNK_SIZE entries is
+    dispatched as soon as it is read, so the directory is never held in
+    memory; a final task waits for the chunks and reconciles removed users.
+
+    The run's lock is taken here, refreshed by each task and released once
+    removed users are reconciled, or when any task fails.
+    """
+    sync_ldap = SyncLDAP()
+    lock = sync_ldap.run_lock()
+    if not lock.acquire():
+        raise SyncLocked("A synchronization is already running for %s" % sync_ldap.settings_prefix)
+
+    try:
+        sync_ldap.sync_groups()
+        group_dns = sync_ldap.group_dns
+
+        shards = sync_ldap.user_shards()
+        if shards:
+            tasks = [syncldap_shard.s(base, filterstr, group_dns, lock.owner) for base, filterstr in shards]
+            chord(tasks)(syncldap_reconcile.s(lock.owner).on_error(syncldap_unlock.si(lock.owner)))
+        else:
+            entries = (encode_entry(cname, ldap_attributes) for cname, ldap_attributes in sync_ldap.iter_users()
+                       if isinstance(ldap_attributes, Mapping))
+            task_ids = [syncldap_chunk.delay(chunk, group_dns, lock.owner).id
+                        for chunk in chunked(entries, sync_ldap.settings.TASK_CHUNK_SIZE)]
+            syncldap_collect.delay(task_ids, lock.owner)
+    except Exception:
+        lock.release()
+        raise
+
+
+@shared_task
+def syncldap_shard(base, filterstr, group_dns=None, lock_owner=None):
+    """Search and synchronize one shard of the users, returning the usernames seen."""
     sync_ldap = SyncLDAP()
-    sync_ldap.sync_groups()
-    sync_ldap.sync_users()
+    return sorted(sync_ldap.sync_user_entries(sync_ldap.iter_users(base, filterstr), group_dns, lock_owner))
+
+
+@shared_task
+def syncldap_chunk(entries, group_dns=None, lock_owner=None):
+    """Synchronize a chunk of encoded user entries, returning the usernames seen."""
+    sync_ldap = SyncLDAP()
+    return sorted(sync_ldap.sync_user_entries([decode_entry(entry) for entry in entries], group_dns, lock_owner))
+
+
+@shared_task(bind=True, max_retries=None)
+def syncldap_collect(self, task_ids, lock_owner=None, complete=0, waited=0):
+    """
+    Wait for the chunk tasks of a distributed synchronization, refreshing
+    the run's lock, then reconcile removed users with the usernames they
+    saw. If no chunk task completes for LOCK_TIMEOUT seconds, such as when
+    a worker was lost, the run is abandoned and its lock released.
+    """
+    sync_ldap = SyncLDAP()
+    if lock_owner is not None:
+        sync_ldap.run_lock(lock_owner).refresh()
+
+    results = [self.app.AsyncResult(task_id) for task_id in task_ids]
+    ready = sum(1 for result in results if result.ready())
+    if ready < len(results):
+        waited = 0 if ready > complete else waited + COLLECT_INTERVAL
+        if waited >= sync_ldap.settings.LOCK_TIMEOUT:
+            logger.error("Abandoning distributed synchronization with %d of %d tasks complete" %
+                         (ready, len(results)))
+            syncldap_unlock(lock_owner)
+            return
+        raise self.retry(args=(task_ids, lock_owner, ready, waited), countdown=COLLECT_INTERVAL)
+
+    if not all(result.successful() for result in results):
+        logger.error("Removed users are not reconciled as a distributed synchronization task failed")
+        syncldap_unlock(lock_owner)
+        return
+    syncldap_reconcile([result.result for result in results], lock_owner)
+
+
+@shared_task
+def syncldap_reconcile(results, lock_owner=None):
+    """Call the removed user callbacks for users not seen by any task, then release the run's lock."""
+    sync_ldap = SyncLDAP()
+    try:
+        usernames = set()
+        for result in results:
+            usernames.update(result)
+        sync_ldap.remove_missing_users(usernames, lock_owner)
+    finally:
+        if lock_owner is not None:
+            sync_ldap.run_lock(lock_owner).release()
+
+
+@shared_task
+def syncldap_unlock(lock_owner):
+    """Release the lock of a distributed synchronization whose tasks failed."""
+    if lock_owner is not None:
+        SyncLDAP().run_lock(lock_owner).release()
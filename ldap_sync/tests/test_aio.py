@@ -0,0 +1,51 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+from django.test import TestCase
+
+from ldap_sync.aio import AsyncLDAPSearch
+from ldap_sync.aio import AsyncSyncLDAP
+from ldap_sync.pool import ConnectionPool
+from ldap_sync.tests.test_sync import ldap_user
+
+
+User = get_user_model()
+
+
+class AsyncSyncTests(TestCase):
+    def tearDown(self):
+        ConnectionPool.close_all()
+
+    @override_settings(LDAP_SYNC_GROUP_FILTER='objectClass=group', LDAP_SYNC_GROUP_ATTRIBUTES={'cn': 'name'},
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'])
+    @mock.patch.object(AsyncLDAPSearch, '_apaged_search')
+    def test_sync(self, search):
+        """Searches awaited on the event loop should be synchronized like a blocking synchronization."""
+        User.objects.create(username='carol')
+        pages = {
+            'objectClass=group': [[('cn=staff,o=test', {'cn': [b'staff']})]],
+            'objectCategory=person': [[ldap_user('alice')], [ldap_user('bob')]],
+        }
+
+        async def paged_search(base, filterstr, attrlist, serverctrls=None):
+            for page in pages[filterstr]:
+                yield page
+        search.side_effect = paged_search
+
+        stats = async_to_sync(AsyncSyncLDAP().sync)()
+        self.assertEqual(search.call_count, 2)
+        self.assertTrue(Group.objects.filter(name='staff').exists())
+        self.assertEqual(sorted(User.objects.filter(is_active=True).values_list('username', flat=True)),
+                         ['alice', 'bob'])
+        self.assertEqual(stats.users_created, 2)
+        self.assertEqual(stats.users_removed, 1)
+
+    @override_settings(LDAP_SYNC_SOURCES=['LDAP_SYNC_CORP_'])
+    def test_sources(self):
+        """Several directories should not be synchronized asynchronously."""
+        with self.assertRaises(ImproperlyConfigured):
+            async_to_sync(AsyncSyncLDAP().sync)()
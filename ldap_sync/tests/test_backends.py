@@ -0,0 +1,23 @@
+from unittest import mock
+
+from django.contrib.auth import authenticate
+from django.test import override_settings
+from django.test import TestCase
+
+import ldap
+
+from ldap_sync.sync import SyncLDAP
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['ldap_sync.backends.SyncUserBackend'])
+class SyncUserBackendTests(TestCase):
+    @mock.patch.object(SyncLDAP, 'sync_user')
+    def test_authenticate(self, sync_user):
+        """The user should be synchronized before authentication, without being authenticated."""
+        self.assertIsNone(authenticate(username='alice', password='secret'))
+        sync_user.assert_called_once_with('alice')
+
+    @mock.patch.object(SyncLDAP, 'sync_user', side_effect=ldap.SERVER_DOWN())
+    def test_authenticate_error(self, sync_user):
+        """LDAP errors should not prevent other backends from authenticating."""
+        self.assertIsNone(authenticate(username='alice', password='secret'))
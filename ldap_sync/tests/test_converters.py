@@ -0,0 +1,54 @@
+from datetime import datetime
+from datetime import timezone
+
+from django.test import TestCase
+
+from ldap_sync import converters
+from ldap_sync.converters import AttributeMap
+
+
+class ConverterTests(TestCase):
+    def test_attribute_map(self):
+        """Mapped attributes should be converted, with missing attributes passed as no values."""
+        attribute_map = AttributeMap({
+            'mailNickname': 'username',
+            'userAccountControl': ('is_active', 'ldap_sync.converters.account_enabled'),
+            'memberOf': ('groups', converters.text_list),
+        })
+        self.assertEqual(attribute_map.fields, ['username', 'groups', 'is_active'])
+        self.assertEqual(attribute_map.ldap_name('username'), 'mailNickname')
+        self.assertEqual(attribute_map({'mailNickname': [b'alice'], 'userAccountControl': [b'514']}),
+                         {'username': 'alice', 'groups': [], 'is_active': False})
+        self.assertEqual(attribute_map.map_many([{'userAccountControl': [b'512'], 'memberOf': [b'a', b'b']}]),
+                         [{'username': '', 'groups': ['a', 'b'], 'is_active': True}])
+
+    def test_map_many_errors(self):
+        """Entries a converter fails on should map to None with their error collected."""
+        attribute_map = AttributeMap({'whenChanged': ('last_login', converters.generalized_time)})
+        errors = {}
+        self.assertEqual(attribute_map.map_many([{'whenChanged': [b'invalid']}, {}], errors=errors),
+                         [None, {'last_login': None}])
+        self.assertEqual(list(errors), [0])
+        self.assertIsInstance(errors[0], ValueError)
+
+    def test_times(self):
+        """Generalized time and FILETIME values should convert to aware datetimes."""
+        self.assertEqual(converters.generalized_time([b'20230401123000.5Z']),
+                         datetime(2023, 4, 1, 12, 30, 0, 500000, tzinfo=timezone.utc))
+        self.assertEqual(converters.generalized_time([b'20230401123000+0200']),
+                         datetime(2023, 4, 1, 10, 30, tzinfo=timezone.utc))
+        self.assertEqual(converters.generalized_time([b'20230401123000,5-05']),
+                         datetime(2023, 4, 1, 17, 30, 0, 500000, tzinfo=timezone.utc))
+        with self.assertRaises(ValueError):
+            converters.generalized_time([b'yesterday'])
+        self.assertEqual(converters.filetime([b'133247808000000000']),
+                         datetime(2023, 4, 1, tzinfo=timezone.utc))
+        self.assertIsNone(converters.filetime([b'9223372036854775807']))
+        self.assertIsNone(converters.filetime([b'0']))
+
+    def test_binary(self):
+        """Binary GUIDs and SIDs should convert to their string forms."""
+        self.assertEqual(converters.guid([b'\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10']),
+                         '04030201-0605-0807-090a-0b0c0d0e0f10')
+        sid = b'\x01\x05\x00\x00\x00\x00\x00\x05\x15\x00\x00\x00' + (1000).to_bytes(4, 'little') * 4
+        self.assertEqual(converters.sid([sid]), 'S-1-5-21-1000-1000-1000-1000')
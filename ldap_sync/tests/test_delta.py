@@ -0,0 +1,103 @@
+from unittest import mock
+
+from django.test import TestCase
+
+import ldap
+from ldap.syncrepl import SyncDoneControl
+from ldap.syncrepl import SyncStateControl
+from pyasn1.codec.ber import decoder
+from pyasn1.codec.ber import encoder
+
+from ldap_sync.delta import DirSyncControl
+from ldap_sync.delta import DirSyncRequestValue
+from ldap_sync.delta import DirSyncResponseValue
+from ldap_sync.delta import DirSyncSearch
+from ldap_sync.delta import SyncReplSearch
+from ldap_sync.settings import LDAPSettings
+
+
+def sync_state(state, identifier, cookie=None):
+    ctrl = SyncStateControl()
+    ctrl.controlType = SyncStateControl.controlType
+    ctrl.state = state
+    ctrl.entryUUID = identifier
+    ctrl.cookie = cookie
+    return ctrl
+
+
+def sync_done(cookie, refresh_deletes):
+    ctrl = SyncDoneControl()
+    ctrl.controlType = SyncDoneControl.controlType
+    ctrl.cookie = cookie
+    ctrl.refreshDeletes = refresh_deletes
+    return ctrl
+
+
+class DeltaTests(TestCase):
+    def setUp(self):
+        self.ldap = mock.Mock(settings=LDAPSettings())
+
+    def test_dirsync_control_encode(self):
+        """The DirSync request value should carry the flags and cookie."""
+        ctrl = DirSyncControl(cookie=b'abc')
+        value, _ = decoder.decode(ctrl.encodeControlValue(), asn1Spec=DirSyncRequestValue())
+        self.assertEqual(int(value.getComponentByName('flags')), DirSyncControl.OBJECT_SECURITY)
+        self.assertEqual(bytes(value.getComponentByName('cookie')), b'abc')
+
+    def test_dirsync_control_decode(self):
+        """The DirSync response value should expose the cookie and more results flag."""
+        value = DirSyncResponseValue()
+        value.setComponentByName('moreResults', 1)
+        value.setComponentByName('unused', 0)
+        value.setComponentByName('cookie', b'next')
+        ctrl = DirSyncControl()
+        ctrl.decodeControlValue(encoder.encode(value))
+        self.assertTrue(ctrl.more_results)
+        self.assertEqual(ctrl.cookie, b'next')
+
+    def test_dirsync_changes(self):
+        """Deleted entries should be reported and partial entries read again."""
+        guid = b'\x01' * 16
+        response = DirSyncControl()
+        response.controlType = DirSyncControl.controlType
+        response.cookie = b'next'
+        self.ldap.conn.result3.return_value = (ldap.RES_SEARCH_RESULT, [
+            ('CN=alice\\0ADEL:1,CN=Deleted Objects,o=test', {'objectGUID': [guid], 'isDeleted': [b'TRUE']}),
+            ('cn=bob,o=test', {'objectGUID': [b'\x02' * 16], 'mail': [b'bob@example.com']}),
+        ], 1, [response])
+        bob = ('cn=bob,o=test', {'objectGUID': [b'\x02' * 16], 'mailNickname': [b'bob'], 'mail': [b'b@example.com']})
+        self.ldap.iter_search.return_value = [bob]
+
+        search = DirSyncSearch(self.ldap)
+        changes = list(search.changes('(objectClass=user)', ['mailNickname', 'mail']))
+        self.assertEqual(changes, [('01010101-0101-0101-0101-010101010101', None),
+                                   ('02020202-0202-0202-0202-020202020202', bob)])
+        self.assertIn('(distinguishedName=cn=bob,o=test)', self.ldap.iter_search.call_args[0][0])
+        self.assertEqual(DirSyncSearch(self.ldap, search.cookie)._cookie, b'next')
+
+    def test_syncrepl_changes(self):
+        """Entry states should be translated into changes and deletions."""
+        alice = ('uid=alice,o=test', {'uid': [b'alice']})
+        self.ldap.conn.result4.side_effect = [
+            (ldap.RES_SEARCH_ENTRY, [(alice[0], alice[1], [sync_state('modify', 'a')])], 1, [], None, None),
+            (ldap.RES_SEARCH_ENTRY, [('uid=bob,o=test', {}, [sync_state('delete', 'b')])], 1, [], None, None),
+            (ldap.RES_SEARCH_RESULT, [], 1, [sync_done('cookie', True)], None, None),
+        ]
+
+        search = SyncReplSearch(self.ldap)
+        changes = [(uuid, entry if entry is None else (entry[0], dict(entry[1])))
+                   for uuid, entry in search.changes('(objectClass=person)', ['uid'])]
+        self.assertEqual(changes, [('a', (alice[0], {'uid': (b'alice',)})), ('b', None)])
+        self.assertEqual(search.cookie, 'cookie')
+        self.assertIsNone(search.present)
+
+    def test_syncrepl_present_phase(self):
+        """Unchanged entries from a present phase should be collected."""
+        self.ldap.conn.result4.side_effect = [
+            (ldap.RES_SEARCH_ENTRY, [('uid=alice,o=test', {}, [sync_state('present', 'a')])], 1, [], None, None),
+            (ldap.RES_SEARCH_RESULT, [], 1, [sync_done('cookie', False)], None, None),
+        ]
+
+        search = SyncReplSearch(self.ldap)
+        self.assertEqual(list(search.changes('(objectClass=person)', ['uid'])), [])
+        self.assertEqual(search.present, {'a'})
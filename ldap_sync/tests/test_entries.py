@@ -0,0 +1,41 @@
+from django.test import TestCase
+
+from ldap_sync.entries import EntryPacker
+
+
+class EntryTests(TestCase):
+    def test_pack(self):
+        """Packed entries should keep only the requested attributes, read as tuples of values."""
+        packer = EntryPacker(['mailNickname', 'memberOf', 'member'])
+        attributes = packer.pack({
+            'mailNickname': [b'alice'],
+            'memberOf': [b'cn=staff,o=test', b'cn=admins,o=test'],
+            'member;range=0-1499': [b'cn=bob,o=test'],
+            'thumbnailPhoto': [b'\xff' * 1024],
+        })
+        self.assertEqual(dict(attributes), {
+            'mailNickname': (b'alice',),
+            'memberOf': (b'cn=staff,o=test', b'cn=admins,o=test'),
+            'member;range=0-1499': (b'cn=bob,o=test',),
+        })
+        self.assertEqual(len(attributes), 3)
+        self.assertNotIn('thumbnailPhoto', attributes)
+        self.assertEqual(attributes.get('mail', []), [])
+
+    def test_shared_index(self):
+        """Entries of one search should share an index of attribute names, even as it grows."""
+        packer = EntryPacker(['mailNickname', 'mail'])
+        alice = packer.pack({'mailNickname': [b'alice']})
+        bob = packer.pack({'mail': [b'bob@example.com'], 'mailNickname': [b'bob']})
+        self.assertIs(alice.index, bob.index)
+        self.assertEqual(dict(alice), {'mailNickname': (b'alice',)})
+        self.assertEqual(dict(bob), {'mailNickname': (b'bob',), 'mail': (b'bob@example.com',)})
+        with self.assertRaises(KeyError):
+            alice['mail']
+
+    def test_pack_page(self):
+        """Search references should be passed through unchanged."""
+        packer = EntryPacker()
+        page = packer.pack_page([('cn=alice,o=test', {'cn': [b'alice']}), (None, ['ldap://other/o=test'])])
+        self.assertEqual(dict(page[0][1]), {'cn': (b'alice',)})
+        self.assertEqual(page[1], (None, ['ldap://other/o=test']))
@@ -0,0 +1,60 @@
+from unittest import mock
+
+from django.test import TestCase
+
+import ldap
+
+from ldap_sync.pool import ConnectionPool
+from ldap_sync.search import LDAPSearch
+from ldap_sync.settings import LDAPSettings
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(['ldap://ldap1', 'ldap://ldap2'], 'cn=alice,ou=example,o=test', 'alicepw')
+
+    def test_least_loaded(self):
+        """Connections should be spread across servers and reused once released."""
+        with mock.patch.object(ConnectionPool, '_bind', side_effect=lambda uri: mock.Mock(uri=uri)) as bind:
+            server1, conn1 = self.pool.acquire()
+            server2, conn2 = self.pool.acquire()
+            self.assertNotEqual(server1.uri, server2.uri)
+
+            self.pool.release(server1, conn1)
+            server3, conn3 = self.pool.acquire()
+            self.assertIs(conn3, conn1)
+            self.assertEqual(bind.call_count, 2)
+
+    def test_failover(self):
+        """An unreachable server should be skipped until its retry delay passes."""
+        def bind(uri):
+            if uri == 'ldap://ldap1':
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+            return mock.Mock(uri=uri)
+
+        with mock.patch.object(ConnectionPool, '_bind', side_effect=bind) as mock_bind:
+            server, conn = self.pool.acquire()
+            self.assertEqual(server.uri, 'ldap://ldap2')
+            self.pool.release(server, conn)
+
+            server, conn = self.pool.acquire()
+            self.assertEqual(server.uri, 'ldap://ldap2')
+            self.assertEqual(mock_bind.call_count, 2)
+
+    def test_all_servers_down(self):
+        """The last error should be raised when no server can be reached."""
+        with mock.patch.object(ConnectionPool, '_bind', side_effect=ldap.SERVER_DOWN({})):
+            with self.assertRaises(ldap.SERVER_DOWN):
+                self.pool.acquire()
+
+    def test_failed_search_discarded(self):
+        """A connection whose search failed should not be returned to the pool."""
+        conn = mock.Mock()
+        conn.search_ext.side_effect = ldap.SERVER_DOWN({})
+        search = LDAPSearch(LDAPSettings())
+        self.addCleanup(ConnectionPool.close_all)
+        with mock.patch.object(ConnectionPool, '_bind', return_value=conn):
+            with self.assertRaises(ldap.SERVER_DOWN):
+                list(search.search_pages('objectCategory=person', ['mailNickname']))
+        self.assertFalse(any(server.idle for server in search.pool.servers))
+        self.assertTrue(any(server.failed_at for server in search.pool.servers))
@@ -0,0 +1,55 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from ldap_sync.reconcile import MergeJoin
+from ldap_sync.settings import LDAPSettings
+
+
+User = get_user_model()
+
+
+class MergeJoinTests(TestCase):
+    def setUp(self):
+        self.settings = LDAPSettings()
+        for username in ['Alice', 'bob', 'carol', 'dave', 'erin', 'frank']:
+            User.objects.create(username=username)
+
+    def pks(self, *usernames):
+        return sorted(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+
+    def test_removed(self):
+        """Local users passed over by the sorted search should be removed, except those kept."""
+        merge = MergeJoin(self.settings, keep={'dave'}, chunk_size=2)
+        merge.advance(['alice', 'bob'])
+        merge.advance(['carol', 'erin'])
+        self.assertEqual(sorted(merge.finish()), self.pks('frank'))
+
+    def test_existing(self):
+        """Each batch should be matched against the local users in its range."""
+        merge = MergeJoin(self.settings, chunk_size=2)
+        existing = merge.advance(['alice', 'anne', 'carol'])
+        self.assertEqual(sorted(existing), ['alice', 'carol'])
+        self.assertEqual(existing['alice'].username, 'Alice')
+        self.assertEqual(sorted(merge.removed), self.pks('bob'))
+
+    def test_index_queries(self):
+        """Local users should be read with keyset queries on the username, not a function of it."""
+        with self.assertNumQueries(4) as queries:
+            merge = MergeJoin(self.settings, chunk_size=2)
+            merge.advance(['alice', 'bob', 'carol', 'dave', 'erin', 'frank'])
+        for query in queries.captured_queries:
+            self.assertNotIn('LOWER', query['sql'].upper())
+
+    def test_failed(self):
+        """Users whose update failed are still synced, so nothing should be removed."""
+        usernames = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank']
+        merge = MergeJoin(self.settings)
+        merge.advance(usernames)
+        self.assertEqual(merge.finish(), [])
+
+    def test_unordered(self):
+        """Nothing should be matched or removed if the search results are not in username order."""
+        merge = MergeJoin(self.settings)
+        merge.advance(['alice', 'carol'])
+        self.assertIsNone(merge.advance(['bob']))
+        self.assertIsNone(merge.finish())
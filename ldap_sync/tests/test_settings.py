@@ -1,7 +1,11 @@
+from unittest import mock
+
+from django.contrib.auth.models import Group
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from django.test.utils import override_settings
 
+from ldap_sync.callbacks import removed_user_delete
 from ldap_sync.settings import LDAPSettings
 
 
@@ -32,3 +36,29 @@ class SettingsTests(TestCase):
         """Check the user attributes validation rule."""
         with self.assertRaises(ImproperlyConfigured):
             settings = LDAPSettings()  # noqa
+
+    @override_settings(LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_delete'])
+    def test_callbacks_resolved(self):
+        """Callback paths should be resolved when settings are loaded."""
+        settings = LDAPSettings()
+        self.assertEqual(settings.removed_user_callbacks, [removed_user_delete])
+
+    @override_settings(LDAP_SYNC_URI='ldap://ldap1 ldap://ldap2')
+    def test_multiple_uris(self):
+        """Several server URIs may be given as a space separated string."""
+        settings = LDAPSettings()
+        self.assertEqual(settings.uris, ['ldap://ldap1', 'ldap://ldap2'])
+
+    @override_settings(LDAP_SYNC_GROUP_FILTER='objectClass=group', LDAP_SYNC_GROUP_ATTRIBUTES={'cn': 'name'},
+                       LDAP_SYNC_GROUP_MEMBERSHIP_ATTRIBUTE='memberOf')
+    def test_validate_groups_relation(self):
+        """Check the group membership validation rule for user models without groups."""
+        with mock.patch.object(LDAPSettings, 'model', Group):
+            with self.assertRaises(ImproperlyConfigured):
+                settings = LDAPSettings()  # noqa
+
+    @override_settings(LDAP_SYNC_SERVER_SORT=True, LDAP_SYNC_SHARD_ATTRIBUTE='mailNickname')
+    def test_validate_server_sort(self):
+        """Check the server side sort validation rule."""
+        with self.assertRaises(ImproperlyConfigured):
+            settings = LDAPSettings()  # noqa
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+from django.test import TestCase
+
+from ldap_sync.search import LDAPSearch
+from ldap_sync.settings import LDAPSettings
+from ldap_sync.snapshot import SnapshotSearch
+from ldap_sync.snapshot import SnapshotWriter
+from ldap_sync.sync import SyncLDAP
+from ldap_sync.tests.test_sync import ldap_user
+
+
+User = get_user_model()
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = LDAPSettings()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        """Entries should be read back exactly as written, including binary values."""
+        path = os.path.join(self.directory, 'snapshot.jsonl.gz')
+        entry = ('cn=alice,o=test', {'mailNickname': [b'alice'], 'objectGUID': [b'\xff\x00\xfe']})
+        with SnapshotWriter(path) as writer:
+            writer.write_search('objectCategory=person', ['mailNickname', 'objectGUID'], [entry])
+
+        search = SnapshotSearch(self.settings, path)
+        self.assertEqual(list(search.iter_search('objectCategory=person', ['mailNickname', 'objectGUID'])), [entry])
+        with self.assertRaises(ValueError):
+            list(search.iter_search('objectCategory=person', ['mailNickname', 'mail']))
+        with self.assertRaises(ValueError):
+            list(search.iter_search('objectClass=group', ['cn']))
+
+    def test_record_replay(self):
+        """A recorded snapshot should synchronize without querying LDAP."""
+        path = os.path.join(self.directory, 'snapshot.jsonl')
+        with mock.patch.object(LDAPSearch, 'iter_search') as search:
+            search.return_value = [ldap_user('alice', 'Alice', 'Smith'), ldap_user('bob', 'Bob', 'Jones')]
+            SyncLDAP().record(path)
+
+        with mock.patch.object(LDAPSearch, '_paged_search_ext') as search:
+            SyncLDAP(snapshot=path).sync()
+            self.assertFalse(search.called)
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['alice', 'bob'])
+
+    @override_settings(LDAP_SYNC_SOURCES=['LDAP_SYNC_LAB_'])
+    def test_sources(self):
+        """Synchronizing other sources from a snapshot should be rejected."""
+        with self.assertRaises(ImproperlyConfigured):
+            SyncLDAP(snapshot=os.path.join(self.directory, 'snapshot.jsonl')).sync()
@@ -1,12 +1,61 @@
-import unittest
+from datetime import timedelta
+from unittest import mock
 
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection
+from django.db import IntegrityError
 from django.test import override_settings
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
 import ldap
 from mockldap import MockLdap
 
+from ldap_sync.models import EntryIdentifier
+from ldap_sync.models import SyncCheckpoint
+from ldap_sync.models import SyncLock
+from ldap_sync.models import SyncState
+from ldap_sync.models import UserFingerprint
+from ldap_sync.pool import ConnectionPool
+from ldap_sync.runs import RunLock
+from ldap_sync.runs import SyncLocked
+from ldap_sync.search import LDAPSearch
+from ldap_sync.signals import sync_finished
 from ldap_sync.sync import SyncLDAP
+from ldap_sync.utils import filter_key
+
+
+User = get_user_model()
+
+
+def ldap_user(username, first_name='', last_name='', email='', **extra):
+    """Build a search result entry in the shape returned by python-ldap."""
+    attributes = {
+        'mailNickname': [username.encode('utf-8')],
+        'givenName': [first_name.encode('utf-8')],
+        'sn': [last_name.encode('utf-8')],
+        'mail': [email.encode('utf-8')],
+    }
+    for name, value in extra.items():
+        attributes[name] = [value.encode('utf-8')]
+    return ('cn=%s,ou=example,o=test' % username, attributes)
+
+
+def rename_carol(user, attributes, created, updated):
+    """Callback forcing a username collision for one user."""
+    if user.username == 'carol':
+        user.username = 'dave'
+
+
+def add_staff_group(user, attributes, created, updated):
+    """Callback adding new users to a group, which needs them inserted."""
+    if created:
+        user.groups.add(Group.objects.get(name='staff'))
+        user.is_staff = True
 
 
 class SyncTests(TestCase):
@@ -33,6 +82,7 @@ class SyncTests(TestCase):
         self.sync = SyncLDAP()
 
     def tearDown(self):
+        ConnectionPool.close_all()
         self.mockldap.stop()
         del self.ldapobj
         del self.sync
@@ -59,3 +109,423 @@ class SyncTests(TestCase):
         """A group sync should not be performed if no filter is provided."""
         self.sync.sync_groups()
         self.assertEqual(self.ldapobj.methods_called(), [])
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_create(self, search):
+        """New LDAP users should be created locally."""
+        search.return_value = [ldap_user('alice', 'Alice', 'Smith'), ldap_user('bob', 'Bob', 'Jones')]
+        self.sync.sync_users()
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['alice', 'bob'])
+        self.assertFalse(User.objects.get(username='alice').has_usable_password())
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_update(self, search):
+        """Existing users should only be written when a field changes."""
+        User.objects.create(username='Alice', first_name='Alice', last_name='Smith')
+        User.objects.create(username='bob', first_name='Bob', last_name='Jones')
+        search.return_value = [ldap_user('alice', 'Alice', 'Brown'), ldap_user('bob', 'Bob', 'Jones')]
+        self.sync.sync_users()
+        self.assertEqual(User.objects.get(username='alice').last_name, 'Brown')
+        self.assertEqual(User.objects.count(), 2)
+
+    @override_settings(LDAP_SYNC_USER_CALLBACKS=['ldap_sync.tests.test_sync.rename_carol'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_batch_error(self, search):
+        """A failing row should not prevent the rest of its batch from being written."""
+        User.objects.create(username='dave')
+        search.return_value = [ldap_user('alice'), ldap_user('bob'), ldap_user('carol')]
+        self.sync.sync_users()
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['alice', 'bob', 'carol', 'dave'])
+        self.assertEqual(self.sync.stats.users_created, 2)
+        self.assertEqual(self.sync.stats.users_errored, 1)
+
+    @override_settings(LDAP_SYNC_USER_CALLBACKS=['ldap_sync.tests.test_sync.rename_carol'],
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_delete'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_update_error(self, search):
+        """A user whose update fails should not be treated as removed."""
+        User.objects.create(username='carol')
+        User.objects.create(username='dave')
+        search.return_value = [ldap_user('carol'), ldap_user('dave')]
+        self.sync.sync_users()
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['carol', 'dave'])
+        self.assertEqual(self.sync.stats.users_errored, 1)
+
+    @override_settings(LDAP_SYNC_USER_ATTRIBUTES={
+        'mailNickname': 'username',
+        'whenChanged': ('last_login', 'ldap_sync.converters.generalized_time'),
+    }, LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_delete'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_conversion_error(self, search):
+        """Entries a converter fails on should be counted as errors without ending the run."""
+        User.objects.create(username='bob')
+        search.return_value = [
+            ldap_user('alice', whenChanged='20230401123000+0200'),
+            ldap_user('bob', whenChanged='invalid'),
+            ldap_user('carol', whenChanged='invalid'),
+        ]
+        self.sync.sync_users()
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['alice', 'bob'])
+        self.assertEqual(self.sync.stats.users_created, 1)
+        self.assertEqual(self.sync.stats.users_errored, 2)
+
+    @override_settings(LDAP_SYNC_GROUP_FILTER='objectClass=group', LDAP_SYNC_GROUP_ATTRIBUTES={'cn': 'name'},
+                       LDAP_SYNC_BATCH_SIZE=2)
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_groups_batch_error(self, search):
+        """A failing group should not roll back the rest of its batch."""
+        get_or_create = Group.objects.get_or_create
+
+        def create_group(**kwargs):
+            if kwargs['name__iexact'] == 'broken':
+                Group.objects.create(name='partial')
+                raise IntegrityError('broken')
+            return get_or_create(**kwargs)
+
+        search.return_value = [('cn=%s,o=test' % name, {'cn': [name.encode('utf-8')]})
+                               for name in ('staff', 'broken', 'admins')]
+        with mock.patch.object(Group.objects, 'get_or_create', side_effect=create_group):
+            self.sync.sync_groups()
+        self.assertEqual(sorted(Group.objects.values_list('name', flat=True)), ['admins', 'staff'])
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_stats(self, search):
+        """A synchronization should return its statistics and send them with a signal."""
+        User.objects.create(username='alice', first_name='Alice', last_name='Smith')
+        User.objects.create(username='bob', first_name='Bob', last_name='Jones')
+        search.return_value = [ldap_user('alice', 'Alice', 'Smith'), ldap_user('bob', 'Bob', 'Brown'),
+                               ldap_user('carol', 'Carol', 'White')]
+        handler = mock.Mock()
+        sync_finished.connect(handler)
+        try:
+            stats = self.sync.sync()
+        finally:
+            sync_finished.disconnect(handler)
+
+        handler.assert_called_once_with(signal=sync_finished, sender=SyncLDAP, stats=stats)
+        self.assertEqual((stats.users_created, stats.users_updated, stats.users_unchanged), (1, 1, 1))
+        self.assertEqual(stats.users_errored, 0)
+        self.assertGreater(stats.queries, 0)
+        self.assertIn('Users created: 1', str(stats))
+
+    @override_settings(LDAP_SYNC_GROUP_FILTER='objectClass=group', LDAP_SYNC_GROUP_ATTRIBUTES={'cn': 'name'},
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_plan(self, search):
+        """A plan should list the changes a synchronization would make without writing them."""
+        Group.objects.create(name='staff')
+        User.objects.create(username='alice', first_name='Alice', last_name='Smith')
+        User.objects.create(username='dave')
+        groups = [('cn=staff,o=test', {'cn': [b'Staff']}), ('cn=admins,o=test', {'cn': [b'admins']})]
+        users = [ldap_user('alice', 'Alice', 'Brown'), ldap_user('bob', 'Bob', 'Jones')]
+        search.side_effect = lambda filterstr, *args, **kwargs: groups if filterstr == 'objectClass=group' else users
+
+        with self.assertNumQueries(2):
+            plan = self.sync.plan()
+        self.assertEqual(plan.created_groups, ['admins'])
+        self.assertEqual(list(plan.created_users), ['bob'])
+        self.assertEqual(plan.updated_users, {'alice': {'last_name': ('Smith', 'Brown')}})
+        self.assertEqual(plan.removed_users, ['dave'])
+        self.assertEqual(User.objects.count(), 2)
+        self.assertTrue(User.objects.get(username='dave').is_active)
+
+    @override_settings(LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'])
+    def test_sync_user_entries(self):
+        """Parts of a distributed synchronization should not remove users until reconciled."""
+        User.objects.create(username='carol')
+        seen = set()
+        seen.update(self.sync.sync_user_entries([ldap_user('alice')]))
+        seen.update(SyncLDAP().sync_user_entries([ldap_user('Bob')]))
+        self.assertEqual(seen, {'alice', 'bob'})
+        self.assertTrue(User.objects.get(username='carol').is_active)
+
+        SyncLDAP().remove_missing_users(seen)
+        self.assertEqual(sorted(User.objects.filter(is_active=True).values_list('username', flat=True)),
+                         ['Bob', 'alice'])
+
+    @override_settings(LDAP_SYNC_SOURCES=['LDAP_SYNC_CORP_', 'LDAP_SYNC_LAB_'],
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'],
+                       LDAP_SYNC_CORP_URI='ldap://localhost', LDAP_SYNC_CORP_BASE='ou=example,o=test',
+                       LDAP_SYNC_CORP_USER_FILTER='objectCategory=person',
+                       LDAP_SYNC_CORP_USER_ATTRIBUTES={'mailNickname': 'username', 'sn': 'last_name'},
+                       LDAP_SYNC_LAB_URI='ldap://localhost', LDAP_SYNC_LAB_BASE='ou=other,o=test',
+                       LDAP_SYNC_LAB_USER_FILTER='objectCategory=person',
+                       LDAP_SYNC_LAB_USER_ATTRIBUTES={'mailNickname': 'username', 'sn': 'last_name'})
+    @mock.patch.object(LDAPSearch, 'search_pages', autospec=True)
+    def test_sync_sources(self, search):
+        """Users from several directories should be merged by precedence and removed across all of them."""
+        User.objects.create(username='carol')
+        pages = {
+            'ou=example,o=test': [[ldap_user('alice', last_name='Corp')]],
+            'ou=other,o=test': [[ldap_user('alice', last_name='Lab'), ldap_user('bob', last_name='Lab')]],
+        }
+        search.side_effect = lambda ldap, filterstr, attrlist, sharded=False, base=None: iter(
+            pages[ldap.settings.BASE])
+
+        stats = self.sync.sync()
+        self.assertEqual(User.objects.get(username='alice').last_name, 'Corp')
+        self.assertEqual(User.objects.get(username='bob').last_name, 'Lab')
+        self.assertFalse(User.objects.get(username='carol').is_active)
+        self.assertEqual(stats.users_created, 2)
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_user(self, search):
+        """A single user should be synchronized on demand, with results and misses cached."""
+        cache.clear()
+        search.return_value = [ldap_user('Alice', last_name='Smith')]
+        user = self.sync.sync_user('alice')
+        self.assertEqual(user.last_name, 'Smith')
+        search.assert_called_once_with('(&(objectCategory=person)(mailNickname=alice))', mock.ANY)
+        self.assertEqual(SyncLDAP().sync_user('ALICE'), user)
+        self.assertEqual(search.call_count, 1)
+
+        search.return_value = []
+        self.assertIsNone(self.sync.sync_user('mallory'))
+        self.assertIsNone(SyncLDAP().sync_user('mallory'))
+        self.assertEqual(search.call_count, 2)
+        self.assertFalse(User.objects.filter(username='mallory').exists())
+
+    def test_get_existing_users(self):
+        """Existing users should be matched on the username index before a case-insensitive fallback."""
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='Bob')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.sync._get_existing_users(['alice', 'bob'], ['Bob']), {'alice': alice, 'bob': bob})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('LOWER', queries[0]['sql'].upper())
+        self.assertEqual(self.sync._get_existing_users(['bob']), {'bob': bob})
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_locked(self, search):
+        """A synchronization should not run while another holds the lock, unless it was abandoned."""
+        search.return_value = [ldap_user('alice')]
+        lock = SyncLock.objects.create(prefix='LDAP_SYNC_', owner='other', heartbeat=timezone.now())
+        with self.assertRaises(SyncLocked):
+            self.sync.sync()
+        self.assertFalse(User.objects.exists())
+
+        SyncLock.objects.filter(pk=lock.pk).update(heartbeat=timezone.now() - timedelta(hours=2))
+        self.sync.sync()
+        self.assertTrue(User.objects.filter(username='alice').exists())
+        self.assertFalse(SyncLock.objects.exists())
+
+    @override_settings(LDAP_SYNC_GROUP_FILTER='objectClass=group', LDAP_SYNC_GROUP_ATTRIBUTES={'cn': 'name'})
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_lock_taken_over(self, search):
+        """A run whose lock was taken over should stop when it next refreshes the lock."""
+        def groups(*args, **kwargs):
+            SyncLock.objects.update(owner='other')
+            return [('cn=staff,o=test', {'cn': [b'staff']})]
+
+        search.side_effect = groups
+        with mock.patch.object(RunLock, 'refresh_interval', 0):
+            with self.assertRaises(SyncLocked):
+                self.sync.sync()
+        self.assertFalse(User.objects.exists())
+        self.assertEqual(list(SyncLock.objects.values_list('owner', flat=True)), ['other'])
+
+    @override_settings(LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_resume(self, search):
+        """An interrupted full synchronization should resume from its checkpoint."""
+        User.objects.create(username='alice', last_name='Smith')
+        User.objects.create(username='carol')
+        SyncCheckpoint.objects.create(prefix='LDAP_SYNC_', key=filter_key('users:checkpoint', 'objectCategory=person'),
+                                      run='interrupted', usernames='["alice"]')
+        search.return_value = [ldap_user('alice', last_name='Brown'), ldap_user('bob')]
+        other = SyncCheckpoint.objects.create(prefix='LDAP_SYNC_', key=filter_key('users:checkpoint', 'other'),
+                                              run='other', usernames='["carol"]')
+
+        self.sync.sync_users()
+        self.assertEqual(User.objects.get(username='alice').last_name, 'Smith')
+        self.assertTrue(User.objects.get(username='alice').is_active)
+        self.assertTrue(User.objects.filter(username='bob').exists())
+        self.assertFalse(User.objects.get(username='carol').is_active)
+        self.assertEqual(list(SyncCheckpoint.objects.values_list('pk', flat=True)), [other.pk])
+
+    def test_iter_search_pages(self):
+        """Entries should be yielded as each page is received."""
+        pages = [[ldap_user('alice')], [ldap_user('bob')]]
+        with mock.patch.object(LDAPSearch, '_paged_search_ext', return_value=iter(pages)):
+            results = self.sync.ldap.iter_search('(objectClass=*)', ['mailNickname'])
+            self.assertEqual(next(results), ldap_user('alice'))
+            self.assertEqual(list(results), [ldap_user('bob')])
+
+    @override_settings(LDAP_SYNC_PREFETCH_PAGES=1)
+    def test_search_pages_prefetch(self):
+        """Prefetched pages should be returned in order and errors re-raised."""
+        def pages():
+            yield [ldap_user('alice')]
+            yield [ldap_user('bob')]
+            raise ldap.SERVER_DOWN()
+
+        with mock.patch.object(LDAPSearch, '_paged_search_ext', return_value=pages()):
+            results = self.sync.ldap.search_pages('(objectClass=*)', ['mailNickname'])
+            self.assertEqual(next(results), [ldap_user('alice')])
+            self.assertEqual(next(results), [ldap_user('bob')])
+            with self.assertRaises(ldap.SERVER_DOWN):
+                next(results)
+
+    @override_settings(LDAP_SYNC_INCREMENTAL_ATTRIBUTE='uSNChanged',
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_delete'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_incremental(self, search):
+        """Later runs should only request entries above the stored high-water mark."""
+        search.return_value = [ldap_user('alice', uSNChanged='9'), ldap_user('bob', uSNChanged='12')]
+        self.sync.sync_users()
+        self.assertEqual(search.call_args[0][0], 'objectCategory=person')
+        self.assertEqual(SyncState.objects.get().prefix, 'LDAP_SYNC_')
+
+        search.return_value = [ldap_user('alice', 'Alice', uSNChanged='15')]
+        self.sync.sync_users()
+        self.assertEqual(search.call_args[0][0], '(&(objectCategory=person)(uSNChanged>=12))')
+        # An incremental run must not treat unseen users as removed
+        self.assertEqual(User.objects.count(), 2)
+        self.assertEqual(User.objects.get(username='alice').first_name, 'Alice')
+
+        self.sync.sync_users(full=True)
+        self.assertEqual(list(User.objects.values_list('username', flat=True)), ['alice'])
+
+    @override_settings(LDAP_SYNC_DELTA_SYNC='syncrepl',
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_delete'])
+    def test_sync_users_delta(self):
+        """Delete notifications should drive the removed user callbacks without a full scan."""
+        delta = mock.Mock(cookie='cookie', present=None)
+        delta.identifier = lambda attributes: attributes['entryUUID'][0].decode('utf-8')
+        delta.changes.return_value = [('a', ldap_user('alice', entryUUID='a')), ('b', ldap_user('bob', entryUUID='b'))]
+        with mock.patch.object(LDAPSearch, 'delta_search', return_value=delta):
+            self.sync.sync_users()
+        self.assertEqual(EntryIdentifier.objects.count(), 2)
+
+        delta.changes.return_value = [('b', None)]
+        with mock.patch.object(LDAPSearch, 'delta_search', return_value=delta) as delta_search:
+            self.sync.sync_users()
+            delta_search.assert_called_with('cookie')
+        self.assertEqual(list(User.objects.values_list('username', flat=True)), ['alice'])
+        self.assertEqual(list(EntryIdentifier.objects.values_list('identifier', flat=True)), ['a'])
+
+    @override_settings(LDAP_SYNC_SERVER_SORT=True,
+                       LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_sorted(self, search):
+        """A sorted user search should be merge joined against the local users to find removed users."""
+        User.objects.create(username='alice', last_name='Smith')
+        User.objects.create(username='carol')
+        search.return_value = [ldap_user('alice', last_name='Brown'), ldap_user('bob')]
+
+        self.sync.sync_users()
+        search.assert_called_once_with('objectCategory=person', mock.ANY, sort='mailNickname')
+        self.assertEqual(User.objects.get(username='alice').last_name, 'Brown')
+        self.assertTrue(User.objects.filter(username='bob').exists())
+        self.assertFalse(User.objects.get(username='carol').is_active)
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_index(self, search):
+        """Unchanged existing users should be matched with a single query."""
+        User.objects.create(username='alice', first_name='Alice')
+        User.objects.create(username='bob', first_name='Bob')
+        search.return_value = [ldap_user('alice', 'Alice'), ldap_user('bob', 'Bob')]
+        with self.settings(LDAP_SYNC_USER_ATTRIBUTES={'mailNickname': 'username', 'givenName': 'first_name'}):
+            sync = SyncLDAP()
+            # Batches also create savepoints, so only count user queries
+            with CaptureQueriesContext(connection) as queries:
+                sync.sync_users()
+        user_queries = [query for query in queries if User._meta.db_table in query['sql']]
+        self.assertEqual(len(user_queries), 1)
+
+    @override_settings(LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_removed_bulk(self, search):
+        """Removed users should be deactivated with a single update per chunk."""
+        for username in ('alice', 'bob', 'carol'):
+            User.objects.create(username=username)
+        search.return_value = [ldap_user('alice')]
+        self.sync.sync_users()
+        self.assertEqual(list(User.objects.filter(is_active=True).values_list('username', flat=True)), ['alice'])
+
+    @override_settings(LDAP_SYNC_GROUP_FILTER='objectClass=group', LDAP_SYNC_GROUP_ATTRIBUTES={'cn': 'name'},
+                       LDAP_SYNC_GROUP_MEMBERSHIP_ATTRIBUTE='memberOf')
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_memberships(self, search):
+        """Group memberships should be added and removed to match LDAP."""
+        staff = Group.objects.create(name='staff')
+        local = Group.objects.create(name='local')
+        bob = User.objects.create(username='bob')
+        bob.groups.add(staff, local)
+        groups = [('cn=staff,o=test', {'cn': [b'staff']}), ('cn=admins,o=test', {'cn': [b'admins']})]
+        users = [ldap_user('alice', memberOf='CN=Staff,o=test'), ldap_user('bob', memberOf='cn=admins,o=test')]
+        search.side_effect = lambda filterstr, *args, **kwargs: groups if filterstr == 'objectClass=group' else users
+
+        self.sync.sync()
+        self.assertEqual(sorted(Group.objects.values_list('name', flat=True)), ['admins', 'local', 'staff'])
+        self.assertEqual(list(User.objects.get(username='alice').groups.values_list('name', flat=True)), ['staff'])
+        self.assertEqual(sorted(bob.groups.values_list('name', flat=True)), ['admins', 'local'])
+
+    @override_settings(LDAP_SYNC_USER_CALLBACKS=['ldap_sync.tests.test_sync.add_staff_group'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_callback_created(self, search):
+        """New users should be inserted before callbacks run, and callback changes saved."""
+        Group.objects.create(name='staff')
+        User.objects.create(username='bob')
+        search.return_value = [ldap_user('alice'), ldap_user('bob')]
+        self.sync.sync_users()
+        alice = User.objects.get(username='alice')
+        self.assertTrue(alice.is_staff)
+        self.assertEqual(list(alice.groups.values_list('name', flat=True)), ['staff'])
+        self.assertFalse(User.objects.get(username='bob').groups.exists())
+        self.assertEqual(self.sync.stats.users_created, 1)
+        self.assertEqual(self.sync.stats.users_updated, 0)
+
+    @override_settings(LDAP_SYNC_USER_CALLBACKS=['ldap_sync.callbacks.user_active_directory_enabled'],
+                       LDAP_SYNC_USER_EXTRA_ATTRIBUTES=['userAccountControl'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_bulk_callback(self, search):
+        """Bulk user callbacks should receive the whole batch before changes are written."""
+        User.objects.create(username='bob')
+        search.return_value = [
+            ldap_user('alice', userAccountControl='512'),
+            ldap_user('bob', userAccountControl='514'),
+        ]
+        with mock.patch('ldap_sync.settings.import_string', wraps=import_string) as resolve:
+            sync = SyncLDAP()
+            sync.sync_users()
+            sync.sync_users()
+            self.assertEqual(resolve.call_count, 1)
+        self.assertEqual(list(User.objects.filter(is_active=True).values_list('username', flat=True)), ['alice'])
+
+    @override_settings(LDAP_SYNC_FINGERPRINT_STORE='ldap_sync.fingerprints.DatabaseFingerprintStore')
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_sync_users_fingerprint(self, search):
+        """Unchanged entries should be skipped without being written."""
+        search.return_value = [ldap_user('alice', 'Alice'), ldap_user('bob', 'Bob')]
+        self.sync.sync_users()
+        self.assertEqual(UserFingerprint.objects.count(), 2)
+
+        search.return_value = [ldap_user('alice', 'Alice'), ldap_user('bob', 'Robert')]
+        with mock.patch.object(User, 'save') as save, mock.patch.object(User.objects, 'bulk_update') as bulk_update:
+            self.sync.sync_users()
+            self.assertFalse(save.called)
+            users, fields = bulk_update.call_args[0]
+            self.assertEqual([user.username for user in users], ['bob'])
+            self.assertEqual(fields, ('first_name',))
+
+    @override_settings(LDAP_SYNC_SHARD_ATTRIBUTE='mailNickname', LDAP_SYNC_SHARD_PREFIXES='ab')
+    def test_search_shards(self):
+        """Prefix shards should cover every entry matching the filter."""
+        self.assertEqual(self.sync.ldap.shards('objectCategory=person'), [
+            ('o=test', '(&(objectCategory=person)(mailNickname=a*))'),
+            ('o=test', '(&(objectCategory=person)(mailNickname=b*))'),
+            ('o=test', '(&(objectCategory=person)(!(|(mailNickname=a*)(mailNickname=b*))))'),
+        ])
+
+    @override_settings(LDAP_SYNC_SEARCH_SHARDS=['ou=example,o=test', 'o=test'])
+    def test_sharded_search(self):
+        """Sharded results should be merged and de-duplicated by DN."""
+        pages = {
+            'ou=example,o=test': [[ldap_user('alice')]],
+            'o=test': [[ldap_user('alice'), ldap_user('bob')]],
+        }
+        with mock.patch.object(LDAPSearch, '_paged_search_ext', side_effect=lambda base, scope, **kwargs: pages[base]):
+            results = list(self.sync.ldap.iter_search('objectCategory=person', ['mailNickname'], sharded=True))
+        self.assertEqual(sorted(cname for cname, attributes in results),
+                         ['cn=alice,ou=example,o=test', 'cn=bob,ou=example,o=test'])
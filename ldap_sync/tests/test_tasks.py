@@ -0,0 +1,98 @@
+from unittest import mock
+from unittest import skipIf
+
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django.test import TestCase
+
+from ldap_sync.models import SyncLock
+from ldap_sync.runs import RunLock
+from ldap_sync.search import LDAPSearch
+from ldap_sync.sync import SyncLDAP
+from ldap_sync.tests.test_sync import ldap_user
+
+try:
+    from celery import Celery
+    from celery import current_app
+    from ldap_sync import tasks
+except ImportError:
+    Celery = None
+
+
+User = get_user_model()
+
+
+@skipIf(Celery is None, "Celery is not installed")
+@override_settings(LDAP_SYNC_REMOVED_USER_CALLBACKS=['ldap_sync.callbacks.removed_user_deactivate'],
+                   LDAP_SYNC_TASK_CHUNK_SIZE=1)
+class DistributedTests(TestCase):
+    def setUp(self):
+        # Run tasks eagerly, storing their results so they can be collected
+        app = Celery('ldap_sync_tests', set_as_current=False)
+        app.conf.update(task_always_eager=True, task_store_eager_result=True, result_backend='cache+memory://')
+        self.addCleanup(current_app._get_current_object().set_current)
+        app.set_current()
+        User.objects.create(username='carol')
+
+    def active_usernames(self):
+        return sorted(User.objects.filter(is_active=True).values_list('username', flat=True))
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_chunks(self, search):
+        """Chunks should be synchronized by separate tasks and removed users reconciled once all complete."""
+        search.return_value = [ldap_user('alice'), ldap_user('bob')]
+        with mock.patch.object(tasks.syncldap_chunk, 'delay', wraps=tasks.syncldap_chunk.delay) as delay:
+            tasks.syncldap_distributed()
+            self.assertEqual(delay.call_count, 2)
+        self.assertEqual(self.active_usernames(), ['alice', 'bob'])
+        self.assertFalse(SyncLock.objects.exists())
+
+    @override_settings(LDAP_SYNC_SEARCH_SHARDS=['ou=staff,o=test', 'ou=lab,o=test'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_shards(self, search):
+        """Each shard should be searched by its own task, with removed users reconciled by the chord."""
+        shards = {'ou=staff,o=test': [ldap_user('alice')], 'ou=lab,o=test': [ldap_user('bob')]}
+        search.side_effect = lambda filterstr, attrlist, base=None, **kwargs: shards[base]
+        tasks.syncldap_distributed()
+        self.assertEqual(self.active_usernames(), ['alice', 'bob'])
+        self.assertFalse(SyncLock.objects.exists())
+
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_chunk_failed(self, search):
+        """A failed chunk should release the lock without reconciling removed users."""
+        search.return_value = [ldap_user('alice'), ldap_user('bob')]
+        sync_user_entries = SyncLDAP.sync_user_entries
+
+        def fail_bob(self, ldap_users, *args):
+            ldap_users = list(ldap_users)
+            if ldap_users[0][0].startswith('cn=bob'):
+                raise RuntimeError('failed')
+            return sync_user_entries(self, ldap_users, *args)
+
+        with mock.patch.object(SyncLDAP, 'sync_user_entries', fail_bob):
+            tasks.syncldap_distributed()
+        self.assertEqual(self.active_usernames(), ['alice', 'carol'])
+        self.assertFalse(SyncLock.objects.exists())
+
+    @override_settings(LDAP_SYNC_SEARCH_SHARDS=['ou=staff,o=test', 'ou=lab,o=test'])
+    @mock.patch.object(LDAPSearch, 'iter_search')
+    def test_shard_failed(self, search):
+        """A failed shard should release the lock without reconciling removed users."""
+        def shard(filterstr, attrlist, base=None, **kwargs):
+            if base == 'ou=lab,o=test':
+                raise RuntimeError('failed')
+            return [ldap_user('alice')]
+
+        search.side_effect = shard
+        with self.assertRaises(RuntimeError):
+            tasks.syncldap_distributed()
+        self.assertEqual(self.active_usernames(), ['alice', 'carol'])
+        self.assertFalse(SyncLock.objects.exists())
+
+    def test_collect_abandoned(self):
+        """Collecting should give up and release the lock once no task has completed for the lock timeout."""
+        lock = RunLock('LDAP_SYNC_', 3600)
+        lock.acquire()
+        tasks.syncldap_collect.apply(args=(['lost'], lock.owner, 0, 3600 - tasks.COLLECT_INTERVAL))
+        self.assertFalse(SyncLock.objects.exists())
+        self.assertEqual(self.active_usernames(), ['carol'])
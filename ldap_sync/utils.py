@@ -0,0 +1,83 @@
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """Yield successive lists of at most ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def filter_key(name, *parts):
+    """Return a short state key identifying a search filter and its options."""
+    digest = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+    return '%s:%s' % (name, digest)
+
+
+def prefetch(iterable, size):
+    """
+    Consume ``iterable`` on a background thread, buffering up to ``size``
+    items ahead of the caller. The bounded buffer provides backpressure so
+    the producer never runs more than ``size`` items ahead, and an exception
+    raised by the producer is re-raised in the consuming thread.
+    """
+    return interleave([iterable], size)
+
+
+def interleave(iterables, size, workers=None):
+    """
+    Consume several iterables concurrently on a pool of ``workers`` threads,
+    yielding their items in the order they are produced. Items are passed
+    through a bounded buffer of ``size`` items, and the first exception
+    raised by any producer is re-raised in the consuming thread.
+    """
+    iterables = list(iterables)
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce(iterable):
+        if stopped.is_set():
+            return
+        try:
+            for value in iterable:
+                if not put((True, value)):
+                    return
+        except Exception as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    executor = ThreadPoolExecutor(max_workers=workers or len(iterables) or 1)
+    futures = [executor.submit(produce, iterable) for iterable in iterables]
+    remaining = len(futures)
+
+    try:
+        while remaining:
+            has_value, value = buffer.get()
+            if has_value:
+                yield value
+            elif value is not None:
+                raise value
+            else:
+                remaining -= 1
+    finally:
+        stopped.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)